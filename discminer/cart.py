@@ -1,5 +1,6 @@
 import numpy as np
 from astropy import units as u
+from .tools.utils import _powerlaw_Rz, hypot_func
 
 au_to_m = u.au.to('m')
 
@@ -28,25 +29,20 @@ def z_lower_powerlaw(coord, z0, p, Rb, q, R0=100):
 def intensity_powerlaw_rout(coord, I0=30.0, R0=100, p=-0.4, z0=100, q=0.3, Rout=500):
     if 'R' not in coord.keys(): R = hypot_func(coord['x'], coord['y'])
     else: R = coord['R']
-    z = coord['z']
     R0*=au_to_m
     z0*=au_to_m
     Rout*=au_to_m
-    A = I0*R0**-p*z0**-q
-    Ieff = np.where(R<=Rout, A*R**p*np.abs(z)**q, 0.0)
+    Ieff = np.where(R<=Rout, _powerlaw_Rz(coord, I0, R0, p, z0, q), 0.0)
     return Ieff
 
 def intensity_powerlaw_rbreak(coord, I0=30.0, p0=-0.4, p1=-0.4, z0=100, q=0.3, Rbreak=20, Rout=500, p=0):
     #p is a dummy variable here
     if 'R' not in coord.keys(): R = hypot_func(coord['x'], coord['y'])
     else: R = coord['R']
-    z = coord['z']
     z0*=au_to_m
     Rout*=au_to_m
     Rbreak*=au_to_m
-    A = I0*Rbreak**-p0*z0**-q
-    B = I0*Rbreak**-p1*z0**-q
-    Ieff = np.where(R<=Rbreak, A*R**p0*np.abs(z)**q, B*R**p1*np.abs(z)**q)
+    Ieff = _powerlaw_Rz(coord, I0, Rbreak, np.where(R<=Rbreak, p0, p1), z0, q) #single evaluation with a piecewise exponent
     ind = R>Rout
     Ieff[ind] = 0.0
     return Ieff
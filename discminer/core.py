@@ -114,7 +114,7 @@ beam : None or `~radio_beam.Beam`, optional
 """
         
 class ModelGrid():
-    def __init__(self, datacube, Rmax, Rmin=1.0, write_extent=True):
+    def __init__(self, datacube, Rmax, Rmin=1.0, write_extent=True, dtype=np.float64):
         """
         Initialise ModelGrid object.
 
@@ -136,6 +136,9 @@ class ModelGrid():
         write_extent : bool
             If True, writes information about grid physical extent into JSON file.
 
+        dtype : data-type, optional
+            Floating-point precision of the sky and disc grids. Defaults to np.float64.
+
         Attributes
         ----------
         skygrid : dict
@@ -149,6 +152,7 @@ class ModelGrid():
         self.dpc = datacube.dpc
         self.Rmax = Rmax
         self.write_extent = write_extent
+        self.dtype = dtype
         
         if isinstance(datacube, Cube):
             self.datacube = datacube
@@ -196,7 +200,7 @@ class ModelGrid():
         #  to the centre of the left/rightmost pixel. To recover the full extent of the sky,
         #   which should be equal to dpix_au*nx, one has to add twice half the pixel size to
         #    account for the total extent of the border pixels.
-        grid = dgrid(xsky, nx) #Transforms xsky from au to metres and computes Cartesian grid
+        grid = dgrid(xsky, nx, dtype=self.dtype) #Transforms xsky from au to metres and computes Cartesian grid
         self.skygrid = grid
 
         # The cell size of the discgrid is the same as that of the skygrid.
@@ -211,7 +215,7 @@ class ModelGrid():
         nx_disc = nx + int(np.round(2*self.Rmax.to(u.au)/dpix_au - nx))
         nx_disc += nx_disc%2 # making it even
         xdisc = (nx_disc-1)*dpix_au/2.0
-        self.discgrid = dgrid(xdisc, nx_disc) #Transforms xdisc from au to metres and computes Cartesian grid
+        self.discgrid = dgrid(xdisc, nx_disc, dtype=self.dtype) #Transforms xdisc from au to metres and computes Cartesian grid
         
         if self.write_extent:
             log_grid = dict(nx=nx, ny=ny, xsky=xsky.value, xdisc=xdisc.value, cellsize=dpix_au.value, unit='au')
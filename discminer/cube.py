@@ -442,7 +442,7 @@ class Cube(object):
             self.writefits(logkeys=[hdrkey], tag=tag, **kwargs_io)
 
             
-    def make_moments(self, method='gaussian', kind='mask', writefits=True, overwrite=True, parcube=True, writecomp=True, tag="", **kwargs_method):
+    def make_moments(self, method='gaussian', kind='mask', writefits=True, overwrite=True, parcube=True, writecomp=True, tag="", keplerian_mask=None, **kwargs_method):
         """
         Make moment maps from line profile observables.
 
@@ -462,6 +462,9 @@ class Cube(object):
              * If 'sum', the composite line profile will be the simple sum of the two-component profiles.
              * If 'mask', the composite line profile intensity in each pixel and velocity channel will be that of the brighter emission surface (between upper and lower surface).
 
+        keplerian_mask : `~discminer.tools.utils.KeplerianMask`, optional
+            If given, line profiles are fitted only on the unmasked channels of each pixel, and fully masked pixels are skipped. See `~discminer.disc2d.Model.make_keplerian_mask`.
+
         """
 
         hdr_int = copy.copy(self.header)        
@@ -493,7 +496,7 @@ class Cube(object):
                 
         if method in ['gaussian', 'gauss', 'bell']:
             _break_line()
-            kwargs_m = dict(method=method, lw_chans=1.0, sigma_fit=None)
+            kwargs_m = dict(method=method, lw_chans=1.0, sigma_fit=None, keplerian_mask=keplerian_mask)
             kwargs_m.update(kwargs_method)            
             moments = fit_onecomponent(self, **kwargs_m)
             moments, n_fit =  moments[:-1], moments[-1]
@@ -540,7 +543,7 @@ class Cube(object):
         
         elif method in ['doublegaussian', 'doublebell']:
             _break_line()
-            kwargs_m = dict(lw_chans=1.0, lower2upper=1.0, sigma_fit=None, method=method, kind=kind)
+            kwargs_m = dict(lw_chans=1.0, lower2upper=1.0, sigma_fit=None, method=method, kind=kind, keplerian_mask=keplerian_mask)
             kwargs_m.update(kwargs_method)
             moments = fit_twocomponent(self,  **kwargs_m)
             moments, n_fit =  moments[:-1], moments[-1]
@@ -4,34 +4,42 @@
 Classes: Model, Mcmc, Velocity, Intensity, Linewidth, Lineslope, ScaleHeight, SurfaceDensity, Temperature
 """
     
+import collections
+import contextlib
 import copy
+import functools
 import itertools
 import numbers
 import os
 import pprint
 import sys
+import threading
 import time
+import types
 import warnings
+from concurrent.futures import ThreadPoolExecutor
 from multiprocessing import Pool
+from multiprocessing.shared_memory import SharedMemory
 
 import matplotlib
 import matplotlib.patches as patches
 import matplotlib.pyplot as plt
 import numpy as np
 from astropy.convolution import Gaussian2DKernel, convolve
+from scipy import fft as sp_fft
 from astropy import units as u
 from matplotlib import ticker
 from scipy.integrate import quad
-from scipy.interpolate import griddata, interp1d
+from scipy.interpolate import interp1d
 from scipy.optimize import curve_fit
-from scipy.special import ellipe, ellipk
-from .tools.utils import FrontendUtils, InputError, _get_beam_from, hypot_func
+from scipy.special import ellipe, ellipk, erf, hyp2f1, log_ndtr
+from .tools.utils import FrontendUtils, InputError, KeplerianMask, LRUCache, OnlineSummary, _freeze, _get_beam_from, _powerlaw_Rz, hypot_func
 from . import constants as sfc
 from . import units as sfu
 from .core import ModelGrid
 from .cube import Cube
 from .rail import Contours
-from .grid import GridTools
+from .grid import GridTools, LineOfSightPlan, ReprojectionPlan
 
 os.environ["OMP_NUM_THREADS"] = "1"
 
@@ -49,38 +57,127 @@ _break_line = FrontendUtils._break_line
 SMALL_SIZE = 10
 MEDIUM_SIZE = 15
 
-def _compute_prop_standard(grid, prop_funcs, prop_kwargs):
+def _get_coord_dict(grid_side):
+    x, y, z, R, phi, R_1d, z_1d = grid_side[:7]
+    coord = {'x': x, 'y': y, 'z': z, 'phi': phi, 'R': R, 'R_1d': R_1d, 'z_1d': z_1d}
+    if len(grid_side) > 7: coord.update(grid_side[7]) #extra coordinates, e.g. cached logR and logz
+    return coord
+
+def _compute_prop_standard(grid, prop_funcs, prop_kwargs, sides=['upper', 'lower']):
     n_funcs = len(prop_funcs)
     props = [{} for i in range(n_funcs)]
-    for side in ['upper', 'lower']:
-        x, y, z, R, phi, R_1d, z_1d = grid[side]
-        coord = {'x': x, 'y': y, 'z': z, 'phi': phi, 'R': R, 'R_1d': R_1d, 'z_1d': z_1d}
+    for side in sides:
+        coord = _get_coord_dict(grid[side])
         for i in range(n_funcs): props[i][side] = prop_funcs[i](coord, **prop_kwargs[i])
     return props
 
-def _compute_prop_mirror(grid, prop_funcs, prop_kwargs):
+def _compute_prop_mirror(grid, prop_funcs, prop_kwargs, shared_grid=True):
+    #Attributes whose kwargs have a 'mirror' key are evaluated on the reference side only and copied to the other side.
+    #If the sides do not share the same (x, y, R, phi) coordinates, e.g. projection='inverse', both sides are evaluated with the same kwargs.
     n_funcs = len(prop_funcs)
     props = [{} for i in range(n_funcs)]
     sides = np.asarray(['upper', 'lower'])
 
     def get_coord_dict(side):
-        x, y, z, R, phi, R_1d, z_1d = grid[side]
-        return {'x': x, 'y': y, 'z': z, 'phi': phi, 'R': R, 'R_1d': R_1d, 'z_1d': z_1d}
+        return _get_coord_dict(grid[side])
         
     for i in range(n_funcs):
-        pkw = prop_kwargs[i]        
-        if 'mirror' in pkw:
-            ref_side = pkw['mirror']
+        pkw = dict(prop_kwargs[i])
+        if 'mirror' in pkw and shared_grid:
+            ref_side = pkw.pop('mirror')
             coord = get_coord_dict(ref_side)
-            pkw.pop('mirror')            
             props[i][ref_side] = prop_funcs[i](coord, **pkw)                
             props[i][sides[sides!=ref_side][0]] = 1*props[i][ref_side]            
         else:
+            pkw.pop('mirror', None)
             for side in sides:
                 coord = get_coord_dict(side)                
                 props[i][side] = prop_funcs[i](coord, **pkw)                
     return props
 
+def _ln_likelihood_chunk(args):
+    #Evaluate a chunk of walkers on a given model instance, see Mcmc.ln_likelihood_batch. Module-level to be picklable.
+    # If model is None, the model attached to this worker process by _init_shared_worker is used.
+    model, params_chunk, kwargs = args
+    if model is None: model = _worker_model
+    return [model.ln_likelihood(params, **kwargs) for params in params_chunk]
+
+#*****************************
+#MODEL THREADS
+#*****************************
+_thread_pools = {} #{(pid, nthreads): ThreadPoolExecutor}, see Intensity._get_model_executor
+_thread_pools_lock = threading.Lock()
+
+def _get_thread_pool(nthreads):
+    #Thread pool of this process, shared by all its model instances (e.g. those unpickled by pool workers or MPI ranks).
+    # Keyed by pid, as threads are not inherited by forked processes.
+    key = (os.getpid(), nthreads)
+    with _thread_pools_lock:
+        if key not in _thread_pools: _thread_pools[key] = ThreadPoolExecutor(max_workers=nthreads, thread_name_prefix='discminer-model')
+        return _thread_pools[key]
+
+def _get_threads_per_process(nthreads, nprocs=1):
+    #Resolve nthreads='auto' into the number of cores available to each of nprocs processes sharing this process' CPU affinity
+    if nthreads != 'auto': return max(1, int(nthreads))
+    ncores = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count()
+    return max(1, ncores//max(1, nprocs))
+
+#*****************************
+#SHARED-MEMORY POOL WORKERS
+#*****************************
+_worker_model = None #Model of this worker process, see Mcmc._get_shared_model
+_worker_shm = [] #Attached shared-memory blocks, must be kept alive while their arrays are in use
+
+def _set_path(obj, path, value):
+    #Set obj.path[0].path[1]... = value, path items being attribute names or dictionary keys
+    for key in path[:-1]: obj = obj[key] if isinstance(obj, dict) else getattr(obj, key)
+    if isinstance(obj, dict): obj[path[-1]] = value
+    else: setattr(obj, path[-1], value)
+
+def _init_shared_worker(model, specs):
+    """
+    Pool initializer. Attach read-only views of the shared-memory arrays described in specs onto model, 
+    which is then used by this worker process to evaluate likelihoods. 
+    Paths sharing a block get the same array, as they did in the parent process.
+    """
+    global _worker_model
+    arrays = {}
+    for path, name, shape, dtype in specs:
+        if name not in arrays:
+            shm = SharedMemory(name=name) #blocks are unlinked by the parent process, see Mcmc.run_mcmc
+            arrays[name] = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+            arrays[name].flags.writeable = False
+            _worker_shm.append(shm)
+        _set_path(model, path, arrays[name])
+    _worker_model = model
+
+def _ln_likelihood_shared(params, **kwargs):
+    return _worker_model.ln_likelihood(params, **kwargs)
+
+_selfgravity_kernels = LRUCache(maxsize=4)
+
+def _get_selfgravity_kernel(R_1d, z_1d):
+    """
+    Kernel matrix K of the disc self-gravity term (Veronesi+2021) on the radial grid R_1d (in au) at heights z_1d (in au),
+    such that SG_1d = K @ surf_dens(R_1d). Kernels are cached and reused as long as R_1d and z_1d do not change.
+    """
+    R_1d, z_1d = np.asarray(R_1d, dtype=np.float64), np.asarray(z_1d, dtype=np.float64)
+    key = (R_1d.tobytes(), z_1d.tobytes())
+    kernel = _selfgravity_kernels.get(key)
+    if kernel is not None: return kernel
+
+    Rp = R_1d[None] #integration variable along columns
+    R, z = R_1d[:, None], z_1d[:, None]
+    dR = np.append(R_1d[0], R_1d[1:]-R_1d[:-1])
+    Rp_R = Rp/R
+    RpxR = Rp*R
+    k2 = 4*RpxR/((R+Rp)**2 + z**2)
+    k = np.sqrt(k2)
+    K1 = ellipk(k2) #It's k2 (not k) here. The def in the Gradshteyn+1980 book differs from that of scipy.
+    E2 = ellipe(k2)
+    kernel = sfc.G*sfu.au * (K1 - 0.25*(k2/(1-k2))*(Rp_R - R/Rp + z**2/RpxR)*E2) * np.sqrt(Rp_R)*k*dR
+    return _selfgravity_kernels.set(key, kernel)
+
 #********************
 #Discminer Attributes
 #********************
@@ -149,11 +246,7 @@ class Linewidth:
 
     @staticmethod
     def linewidth_powerlaw(coord, L0=0.2, p=-0.4, q=0.3, R0=100*sfu.au, z0=100*sfu.au):
-        if 'R' not in coord.keys(): R = hypot_func(coord['x'], coord['y'])
-        else: R = coord['R'] 
-        z = coord['z']        
-        A = L0*R0**-p*z0**-q
-        return A*R**p*np.abs(z)**q
+        return _powerlaw_Rz(coord, L0, R0, p, z0, q)
 
 
 class Lineslope:
@@ -176,11 +269,7 @@ class Lineslope:
         if p==0.0 and q==0.0:
             return Ls
         else:
-            if 'R' not in coord.keys(): R = hypot_func(coord['x'], coord['y'])
-            else: R = coord['R'] 
-            z = coord['z']        
-            A = Ls*R0**-p*z0**-q
-            return A*R**p*np.abs(z)**q
+            return _powerlaw_Rz(coord, Ls, R0, p, z0, q)
 
 
 class ScaleHeight:
@@ -256,11 +345,7 @@ class Temperature:
 
     @staticmethod
     def temperature_powerlaw(coord, T0=100.0, R0=100*sfu.au, p=-0.4, z0=100*sfu.au, q=0.3):
-        if 'R' not in coord.keys(): R = hypot_func(coord['x'], coord['y'])
-        else: R = coord['R'] 
-        z = coord['z']        
-        A = T0*R0**-p*z0**-q
-        return A*R**p*np.abs(z)**q        
+        return _powerlaw_Rz(coord, T0, R0, p, z0, q)
 
 
 class Velocity:
@@ -303,7 +388,7 @@ class Velocity:
         else: R = coord['R'] 
         if 'r' not in coord.keys(): r = hypot_func(R, coord['z'])
         else: r = coord['r']
-        return vel_sign*np.sqrt(sfc.G*Mstar/r**3)*R * 1e-3 
+        return vel_sign*np.sqrt(sfc.G*Mstar/r)*(R/r) * 1e-3 
 
     @staticmethod
     def keplerian_pressure(coord, Mstar=1.0, vel_sign=1, vsys=0,
@@ -343,7 +428,7 @@ class Velocity:
         H = ScaleHeight.powerlaw({'R': R}, H0=H0, R0=R0, psi=psi)
         vk2 = sfc.G*Mstar/R
         vp2 = vk2*( -alpha*(H/R)**2 + (2/z_R32)*( 1+1.5*z_R2-z_R32-dlogH_dlogR*(1+z_R2-z_R32) ) ) #pressure term        
-        return vel_sign*np.sqrt(R**2*sfc.G*Mstar/r**3 + vp2) * 1e-3 
+        return vel_sign*np.sqrt((R/r)**2*sfc.G*Mstar/r + vp2) * 1e-3 
 
     
     @staticmethod
@@ -361,28 +446,12 @@ class Velocity:
         R_1d = coord['R_1d'] #in au to ease computing below
         z_1d = coord['z_1d'] #in au
         
-        def SG_integral(Rp, R, z):
-            dR = np.append(Rp[0], Rp[1:]-Rp[:-1]) ##
-            Rp_R = Rp/R
-            RpxR = Rp*R
-            k2 = 4*RpxR/((R+Rp)**2 + z**2)
-            k = np.sqrt(k2)
-            K1 = ellipk(k2) #It's k2 (not k) here. The def in the Gradshteyn+1980 book differs from that of scipy.
-            E2 = ellipe(k2)
-            #surf_dens = SurfaceDensity.powerlaw_tapered({'R': Rp*sfu.au}, Ec=Ec, Rc=Rc, gamma=gamma)
-            surf_dens = surfacedensity_func({'R': Rp*sfu.au}, Ec=Ec, Rc=Rc, gamma=gamma)
-            val = (K1 - 0.25*(k2/(1-k2))*(Rp_R - R/Rp + z**2/RpxR)*E2) * np.sqrt(Rp_R)*k*surf_dens
-            #return sfc.G*val*sfu.au 
-            return sfc.G*np.sum(val*dR)*sfu.au ##
-
-        R_len = len(R_1d)
-        SG_1d = []    
-        for i in range(R_len):
-            #SG_1d.append(quad(SG_integral, 0, np.inf, args=(R_1d[i], z_1d[i]), limit=100)[0])
-            SG_1d.append(SG_integral(R_1d, R_1d[i], z_1d[i])) ##
+        #Elliptic-integral kernel depends only on R_1d and z_1d, SG is linear in the surface density
+        surf_dens = surfacedensity_func({'R': R_1d*sfu.au}, Ec=Ec, Rc=Rc, gamma=gamma)
+        SG_1d = _get_selfgravity_kernel(R_1d, z_1d) @ surf_dens
         SG_2d = interp1d(R_1d, SG_1d)
 
-        return vel_sign*np.sqrt(R**2*sfc.G*Mstar/r**3 + SG_2d(R/sfu.au)) * 1e-3 
+        return vel_sign*np.sqrt((R/r)**2*sfc.G*Mstar/r + SG_2d(R/sfu.au)) * 1e-3 
     
     @staticmethod
     def keplerian_vertical_selfgravity_pressure(coord, Mstar=1.0, vel_sign=1, vsys=0,
@@ -399,24 +468,8 @@ class Velocity:
         R_1d = coord['R_1d'] 
         z_1d = coord['z_1d'] 
         
-        def SG_integral(Rp, R, z):
-            dR = np.append(Rp[0], Rp[1:]-Rp[:-1]) ##
-            Rp_R = Rp/R
-            RpxR = Rp*R
-            k2 = 4*RpxR/((R+Rp)**2 + z**2)
-            k = np.sqrt(k2)
-            K1 = ellipk(k2) #It's k2 (not k) here. The def in the Gradshteyn+1980 book differs from that of scipy.
-            E2 = ellipe(k2)
-            surf_dens = SurfaceDensity.powerlaw({'R': Rp*sfu.au}, Ec=Ec, Rc=Rc, gamma=gamma)
-            val = (K1 - 0.25*(k2/(1-k2))*(Rp_R - R/Rp + z**2/RpxR)*E2) * np.sqrt(Rp_R)*k*surf_dens
-            #return sfc.G*val*sfu.au 
-            return sfc.G*np.sum(val*dR)*sfu.au ##
-
-        R_len = len(R_1d)
-        SG_1d = []    
-        for i in range(R_len):
-            #SG_1d.append(quad(SG_integral, 0, np.inf, args=(R_1d[i], z_1d[i]), limit=100)[0])
-            SG_1d.append(SG_integral(R_1d, R_1d[i], z_1d[i])) ##
+        surf_dens = SurfaceDensity.powerlaw({'R': R_1d*sfu.au}, Ec=Ec, Rc=Rc, gamma=gamma)
+        SG_1d = _get_selfgravity_kernel(R_1d, z_1d) @ surf_dens
         SG_2d = interp1d(R_1d, SG_1d)
 
         #compute pressure support
@@ -430,7 +483,7 @@ class Velocity:
         vk2 = sfc.G*Mstar/R
         vp2 = vk2*( -alpha*(H/R)**2 + (2/z_R32)*( 1+1.5*z_R2-z_R32-dlogH_dlogR*(1+z_R2-z_R32) ) )
         
-        return vel_sign*np.sqrt(R**2*sfc.G*Mstar/r**3 + SG_2d(R/sfu.au) + vp2) * 1e-3 
+        return vel_sign*np.sqrt((R/r)**2*sfc.G*Mstar/r + SG_2d(R/sfu.au) + vp2) * 1e-3 
     
 
 class Intensity:   
@@ -456,6 +509,7 @@ class Intensity:
     def beam_kernel(self, beam_kernel): 
         print('Setting beam_kernel var to', beam_kernel)
         self._beam_kernel = beam_kernel
+        self._beam_fft_cache = LRUCache(maxsize=8) #Padded kernel FFTs, see _convolve_fft
         
     @beam_kernel.deleter 
     def beam_kernel(self): 
@@ -500,14 +554,17 @@ class Intensity:
         return self._use_full_channel
 
     @use_full_channel.setter 
-    def use_full_channel(self, use): #Needs a remake considering new kernels
+    def use_full_channel(self, use):
         use = bool(use)
         print('Setting use_full_channel var to', use)
+        is_bell = self.line_profile in [Intensity.line_profile_bell, Intensity.line_profile_bell_full]
         if use: 
             if self.use_temperature: self.line_profile = self.line_profile_temp_full
+            elif is_bell: self.line_profile = self.line_profile_bell_full
             else: self.line_profile = self.line_profile_v_sigma_full
         else: 
             if self.use_temperature: self.line_profile = self.line_profile_temp
+            elif is_bell: self.line_profile = self.line_profile_bell
             else: self.line_profile = self.line_profile_v_sigma
         self._use_full_channel = use
 
@@ -516,6 +573,92 @@ class Intensity:
         print('Deleting use_full_channel var') 
         del self._use_full_channel
 
+    @property
+    def convolution(self):
+        return self._convolution
+
+    @convolution.setter 
+    def convolution(self, method): 
+        if method not in ['fft', 'astropy']:
+            raise InputError(method, "convolution must be 'fft' or 'astropy'")
+        print('Setting beam convolution method to', method)
+        self._convolution = method
+
+    @convolution.deleter 
+    def convolution(self): 
+        print('Deleting convolution var') 
+        del self._convolution
+
+    @property
+    def fft_workers(self):
+        return self._fft_workers
+
+    @fft_workers.setter 
+    def fft_workers(self, workers): 
+        print('Setting number of workers for FFT convolution to', workers)
+        self._fft_workers = workers
+
+    @fft_workers.deleter 
+    def fft_workers(self): 
+        print('Deleting fft_workers var') 
+        del self._fft_workers
+
+    @property
+    def nthreads_model(self):
+        return self._nthreads_model
+
+    @nthreads_model.setter 
+    def nthreads_model(self, nthreads): 
+        print('Setting number of threads for the forward model to', nthreads)
+        self._nthreads_model = max(1, int(nthreads))
+
+    @nthreads_model.deleter 
+    def nthreads_model(self): 
+        print('Deleting nthreads_model var') 
+        del self._nthreads_model
+
+    def _get_model_executor(self):
+        #Thread pool shared by the stages of the forward model, None if nthreads_model=1
+        if self.nthreads_model <= 1: return None
+        return _get_thread_pool(self.nthreads_model)
+
+    def _map_sides(self, func, parallel=True):
+        #{side: func(side)} for the upper and lower emission surfaces, evaluated concurrently by the model threads if available
+        executor = self._get_model_executor() if parallel else None
+        if executor is None: return {side: func(side) for side in ['upper', 'lower']}
+        futures = {side: executor.submit(func, side) for side in ['upper', 'lower']}
+        return {side: futures[side].result() for side in futures}
+
+    @property
+    def memory_budget(self):
+        return self._memory_budget
+
+    @memory_budget.setter 
+    def memory_budget(self, mb): 
+        print('Setting memory budget for batched channel synthesis to %s MB'%mb)
+        self._memory_budget = mb
+
+    @memory_budget.deleter 
+    def memory_budget(self): 
+        print('Deleting memory_budget var') 
+        del self._memory_budget
+
+    @property
+    def line_profile_cutoff(self):
+        return self._line_profile_cutoff
+
+    @line_profile_cutoff.setter 
+    def line_profile_cutoff(self, k): 
+        if k is not None and k <= 0:
+            raise InputError(k, 'line_profile_cutoff must be a positive number of linewidths, or None')
+        print('Setting line profile cutoff to', k, 'linewidths')
+        self._line_profile_cutoff = k
+
+    @line_profile_cutoff.deleter 
+    def line_profile_cutoff(self): 
+        print('Deleting line_profile_cutoff var') 
+        del self._line_profile_cutoff
+
     @property
     def line_profile(self): 
         return self._line_profile
@@ -560,31 +703,45 @@ class Intensity:
 
     @staticmethod
     def intensity_powerlaw(coord, I0=30.0, R0=100*sfu.au, p=-0.4, z0=100*sfu.au, q=0.3):
-        if 'R' not in coord.keys(): R = hypot_func(coord['x'], coord['y'])
-        else: R = coord['R'] 
-        z = coord['z']        
-        A = I0*R0**-p*z0**-q
-        return A*R**p*np.abs(z)**q
+        return _powerlaw_Rz(coord, I0, R0, p, z0, q)
         
     @staticmethod
     def nuker(coord, I0=30.0, Rt=100*sfu.au, alpha=-0.5, gamma=0.1, beta=0.2):
         if 'R' not in coord.keys(): R = hypot_func(coord['x'], coord['y'])
         else: R = coord['R'] 
-        A = I0*Rt**gamma
-        return A*(R**-gamma) * (1+(R/Rt)**alpha)**((gamma-beta)/alpha)
+        return I0*(R/Rt)**-gamma * (1+(R/Rt)**alpha)**((gamma-beta)/alpha)
 
     @staticmethod
-    def line_profile_subchannel(line_profile_func, v_chan, v, v_sigma, b_slope, channel_width=0.1, **kwargs):
+    @functools.lru_cache(maxsize=32)
+    def _leggauss(n):
+        return np.polynomial.legendre.leggauss(n)
+    
+    @staticmethod
+    def _channel_nodes(channel_width, v_sigma, nodes_per_sigma=2, nmax=20):
+        """
+        Gauss-Legendre nodes (offsets from the channel centre) and weights to average a line profile over a channel.
+        The number of nodes adapts to the ratio between the channel width and the narrowest line width, 
+        from 2 nodes if lines are broader than about twice the channel width to nmax for unresolved lines.
+        """
+        ratio = np.abs(channel_width)/np.nanmin(np.abs(v_sigma))
+        nsub = int(np.clip(np.ceil(nodes_per_sigma*ratio)+1, 2, nmax)) if np.isfinite(ratio) else nmax
+        x, w = Intensity._leggauss(nsub)
+        return 0.5*channel_width*x, 0.5*w
+
+    @staticmethod
+    def _gauss_channel_integral(v_chan, v, v_sigma, channel_width):
+        #Exact average of exp(-0.5*((v-u)/v_sigma)**2) over u in [v_chan - channel_width/2, v_chan + channel_width/2]
         half_chan = 0.5*channel_width
-        v0 = v_chan - half_chan
-        v1 = v_chan + half_chan
-        nsub = 10
-        vsub = np.linspace(v0, v1, nsub)
-        dvsub = vsub[1]-vsub[0]
+        fac = 1/(np.sqrt(2)*v_sigma)
+        dv = v_chan - v
+        return np.sqrt(0.5*np.pi)*v_sigma/channel_width * (erf((dv+half_chan)*fac) - erf((dv-half_chan)*fac))
+    
+    @staticmethod
+    def line_profile_subchannel(line_profile_func, v_chan, v, v_sigma, b_slope, channel_width=0.1, **kwargs):
+        vsub, wsub = Intensity._channel_nodes(channel_width, v_sigma)
         J = 0
-        for vs in vsub:
-            J += line_profile_func(vs, v, v_sigma, b_slope, **kwargs) 
-        J = J * dvsub/channel_width
+        for vs, ws in zip(vsub, wsub):
+            J += ws*line_profile_func(v_chan+vs, v, v_sigma, b_slope, **kwargs) 
         return J
         
     @staticmethod
@@ -596,17 +753,7 @@ class Intensity:
     @staticmethod
     def line_profile_temp_full(v_chan, v, T, dum, v_turb=0, mmol=2*sfu.amu, channel_width=0.1):
         v_sigma = np.sqrt(sfc.kb*T/mmol + v_turb**2) * 1e-3 #in km/s
-        half_chan = 0.5*channel_width
-        v0 = v_chan - half_chan
-        v1 = v_chan + half_chan
-        nsub = 10
-        vsub = np.linspace(v0, v1, nsub)
-        dvsub = vsub[1]-vsub[0]
-        J = 0
-        for vs in vsub:
-            J += np.exp(-0.5*((v-vs)/v_sigma)**2)
-        J = J * dvsub/channel_width
-        return J
+        return Intensity._gauss_channel_integral(v_chan, v, v_sigma, channel_width)
 
     @staticmethod
     def line_profile_v_sigma(v_chan, v, v_sigma, dum):
@@ -616,35 +763,27 @@ class Intensity:
     
     @staticmethod
     def line_profile_v_sigma_full(v_chan, v, v_sigma, dum, channel_width=0.1):
-        half_chan = 0.5*channel_width
-        v0 = v_chan - half_chan
-        v1 = v_chan + half_chan
-        nsub = 10
-        vsub = np.linspace(v0, v1, nsub)
-        dvsub = vsub[1]-vsub[0]
-        J = 0
-        for vs in vsub:
-            J += np.exp(-0.5*((v-vs)/v_sigma)**2)
-        J = J * dvsub/channel_width
-        return J
+        return Intensity._gauss_channel_integral(v_chan, v, v_sigma, channel_width)
 
     @staticmethod
     def line_profile_bell(v_chan, v, v_sigma, b_slope):
         return 1/(1+np.abs((v-v_chan)/v_sigma)**(2*b_slope))        
 
+    @staticmethod
+    def _bell_antiderivative(x, b_slope):
+        #Primitive of 1/(1+|x|**k), k=2*b_slope: x * 2F1(1, 1/k; 1+1/k; -|x|**k). Valid for any b_slope > 0
+        k = 2*b_slope
+        return x*hyp2f1(1, 1/k, 1+1/k, -np.abs(x)**k)
+
     @staticmethod
     def line_profile_bell_full(v_chan, v, v_sigma, b_slope, channel_width=0.1):
+        #Exact average of the bell kernel over u in [v_chan - channel_width/2, v_chan + channel_width/2], from its antiderivative.
+        # Quadratures converge slowly for this kernel, it has a cusp at the line centre if b_slope < 1 and sharp edges if b_slope >> 1
         half_chan = 0.5*channel_width
-        v0 = v_chan - half_chan
-        v1 = v_chan + half_chan
-        nsub = 10
-        vsub = np.linspace(v0, v1, nsub)
-        dvsub = vsub[1]-vsub[0]
-        J = 0
-        for vs in vsub:
-            J += 1/(1+np.abs((v-vs)/v_sigma)**(2*b_slope))
-        J = J * dvsub/channel_width
-        return J
+        dv = v_chan - v
+        F = Intensity._bell_antiderivative
+        J = v_sigma/channel_width * (F((dv+half_chan)/v_sigma, b_slope) - F((dv-half_chan)/v_sigma, b_slope))
+        return J.astype(np.result_type(v_chan, v, v_sigma), copy=False) #hyp2f1 has no single-precision loop
 
     @staticmethod
     def line_uplow_sum(Iup, Ilow):
@@ -653,17 +792,46 @@ class Intensity:
     @staticmethod
     def line_uplow_mask(Iup, Ilow):
         #velocity nans might differ from Int nans when a z surf is zero and SG is active, nanmax must be used
-        return np.nanmax([Iup, Ilow], axis=0)
+        # --> np.fmax is equivalent to np.nanmax over [Iup, Ilow] but avoids stacking both arrays
+        return np.fmax(Iup, Ilow)
+
+    def _convolve_fft(self, chans):
+        """
+        Convolve a stack of channels, shape (nchan, ny, nx), with the beam kernel using real FFTs.
+        Equivalent to astropy's convolve with boundary='fill', fill_value=0 and normalize_kernel=True. 
+        The padded FFT of the kernel is computed only once for each channel shape.
+        """
+        shape = chans.shape[-2:]
+        key = (shape, chans.dtype.str)
+        cached = self._beam_fft_cache.get(key)
+        if cached is None:
+            kernel = np.asarray(getattr(self.beam_kernel, 'array', self.beam_kernel))
+            kernel = (kernel/kernel.sum()).astype(chans.dtype)
+            fshape = tuple(sp_fft.next_fast_len(n+k-1, real=True) for n, k in zip(shape, kernel.shape))
+            cached = self._beam_fft_cache.set(key, (sp_fft.rfft2(kernel, s=fshape), fshape, kernel.shape))
+        kernel_fft, fshape, (ky, kx) = cached
+        workers = self.fft_workers
+        chans_fft = sp_fft.rfft2(chans, s=fshape, workers=workers)
+        chans_fft *= kernel_fft
+        conv = sp_fft.irfft2(chans_fft, s=fshape, workers=workers)
+        return conv[..., ky//2:ky//2+shape[0], kx//2:kx//2+shape[1]]
+    
+    def _get_channel_chunk(self, shape):
+        #Number of channels synthesised at once, given the memory budget and the size of the temporary arrays.
+        # ~8 temporary arrays per channel (per subpixel) are alive while computing line profiles in get_cube.
+        nsub = self.subpixels_sq if self.subpixels else 1
+        chan_bytes = 8 * nsub * np.prod(shape) * np.dtype(self.dtype).itemsize
+        return int(max(1, self.memory_budget*1024**2 // chan_bytes))
     
     def get_line_profile(self, v_chan, vel2d, linew2d, lineb2d, **kwargs):
         if self.subpixels:
-            v_near, v_far = [], []
-            for i in range(self.subpixels_sq):
-                v_near.append(self.line_profile(v_chan, vel2d[i]['upper'], linew2d['upper'], lineb2d['upper'], **kwargs))
-                v_far.append(self.line_profile(v_chan, vel2d[i]['lower'], linew2d['lower'], lineb2d['lower'], **kwargs))
-
-            integ_v_near = np.sum(np.array(v_near), axis=0) * self.sub_dA / self.pix_dA
-            integ_v_far = np.sum(np.array(v_far), axis=0) * self.sub_dA / self.pix_dA
+            #Subpixel velocities have shape (subpixels**2, ny, nx), a subpixel axis is inserted before the spatial axes of v_chan
+            v_chan = np.asarray(v_chan)
+            if v_chan.ndim: v_chan = np.expand_dims(v_chan, -3)
+            v_near = self.line_profile(v_chan, vel2d['upper'], linew2d['upper'], lineb2d['upper'], **kwargs)
+            v_far = self.line_profile(v_chan, vel2d['lower'], linew2d['lower'], lineb2d['lower'], **kwargs)
+            integ_v_near = np.sum(v_near, axis=-3) * self.sub_dA / self.pix_dA
+            integ_v_far = np.sum(v_far, axis=-3) * self.sub_dA / self.pix_dA
             return integ_v_near, integ_v_far
         
         else: 
@@ -671,6 +839,72 @@ class Intensity:
             v_far = self.line_profile(v_chan, vel2d['lower'], linew2d['lower'], lineb2d['lower'], **kwargs)
             return v_near, v_far 
 
+    def _get_profile_halfwidth(self, width, b_slope=None, cutoff=None, **kwargs):
+        """
+        Velocity half-width beyond which line profiles are set to zero, given the line width (or temperature) and, for bell profiles, the line slope.
+
+        For Gaussian kernels the half-width is cutoff linewidths (defaults to line_profile_cutoff), where the kernel has dropped to exp(-cutoff**2/2).
+        The tails of the bell kernel decay as a power law, |x|**(-2*b_slope), so its half-width is taken where the kernel drops to that same value,
+        i.e. x = ((1-tol)/tol)**(1/(2*b_slope)) linewidths with tol=exp(-cutoff**2/2). This grows quickly for b_slope < 1 (e.g. 4.7e5 linewidths 
+        for cutoff=5, b_slope=0.5), in which case profiles are in practice not truncated. Pass the smallest b_slope of the pixels involved.
+        """
+        if self.use_temperature:
+            width = np.sqrt(sfc.kb*width/kwargs.get('mmol', 2*sfu.amu) + kwargs.get('v_turb', 0.0)**2) * 1e-3
+        cutoff = self.line_profile_cutoff if cutoff is None else cutoff
+        if b_slope is not None and self.line_profile in [Intensity.line_profile_bell, Intensity.line_profile_bell_full]:
+            tol = np.exp(-0.5*cutoff**2)
+            with np.errstate(over='ignore'): cutoff = ((1-tol)/tol)**(1/(2*np.asarray(b_slope, dtype=np.float64)))
+        half = cutoff*width
+        if self.use_full_channel: half += 0.5*np.abs(kwargs.get('channel_width', 0.1))
+        return half
+
+    def _get_velocity_bands(self, vel2d, int2d, linew2d, lineb2d, **kwargs):
+        #Valid pixels of each emission surface sorted by line-of-sight velocity, see get_line_profile_sparse
+        bands = {}
+        for side in ['upper', 'lower']:
+            shape = np.shape(vel2d[side])
+            v, I, lw, lb = [np.ravel(attr) for attr in np.broadcast_arrays(vel2d[side], int2d[side], linew2d[side], lineb2d[side])]
+            valid = np.isfinite(v) & np.isfinite(I) & np.isfinite(lw) & np.isfinite(lb)
+            ind = np.flatnonzero(valid)
+            ind = ind[np.argsort(v[ind], kind='stable')]
+            half = self._get_profile_halfwidth(np.max(lw[ind]) if ind.size else 0.0, b_slope=np.min(lb[ind]) if ind.size else None, **kwargs)
+            bands[side] = {'ind': ind, 'v': v[ind], 'I': I[ind], 'lw': lw[ind], 'lb': lb[ind],
+                           'half': half, 'shape': shape,
+                           'base': np.where(valid, 0, np.nan).astype(self.dtype)}
+        return bands
+
+    def get_line_profile_sparse(self, v_chan, bands, **kwargs):
+        """
+        Intensity-weighted line profiles of the upper and lower surfaces on a set of channels, evaluated only on 
+        pixels whose velocity is within line_profile_cutoff linewidths of each channel (more for bell kernels, see _get_profile_halfwidth). Profiles are set to zero elsewhere.
+
+        Parameters
+        ----------
+        v_chan : array_like, shape (nchan,)
+            Channel velocities.
+
+        bands : dict
+            Pixels sorted by velocity for each surface, as returned by ``_get_velocity_bands``.
+
+        Returns
+        -------
+        v_near, v_far : array_like, shape (nchan, ny, nx)
+        """
+        nchan = len(v_chan)
+        profiles = []
+        for side in ['upper', 'lower']:
+            band = bands[side]
+            ind, v, I, lw, lb = band['ind'], band['v'], band['I'], band['lw'], band['lb']
+            chans = np.repeat(band['base'][None], nchan, axis=0)
+            lo = np.searchsorted(v, v_chan - band['half'], side='left')
+            hi = np.searchsorted(v, v_chan + band['half'], side='right')
+            for i in range(nchan):
+                j0, j1 = lo[i], hi[i]
+                if j1 > j0:
+                    chans[i, ind[j0:j1]] = I[j0:j1]*self.line_profile(v_chan[i], v[j0:j1], lw[j0:j1], lb[j0:j1], **kwargs)
+            profiles.append(chans.reshape((nchan,)+band['shape']))
+        return profiles
+    
     def get_channel(self, velocity2d, intensity2d, linewidth2d, lineslope2d, v_chan, **kwargs):                    
         vel2d, int2d, linew2d, lineb2d = velocity2d, {}, {}, {}
 
@@ -689,11 +923,21 @@ class Intensity:
 
         return int2d_full
 
-    def get_cube(self, vchannels, velocity2d, intensity2d, linewidth2d, lineslope2d, make_convolve=True,
-                 rms=None, tb={'nu': False, 'beam': False, 'full': True}, return_data_only=False, header=None, dpc=None, **kwargs_line):
-        
+    def iter_cube(self, vchannels, velocity2d, intensity2d, linewidth2d, lineslope2d, make_convolve=True, rms=None, **kwargs_line):
+        """
+        Synthesise the model cube in chunks of channels, without allocating the whole cube.
+        The number of channels per chunk is set by memory_budget.
+
+        Yields
+        ------
+        i0, i1 : int
+            First and last (exclusive) channel indices of the chunk.
+
+        chans : array_like, shape (i1-i0, ny, nx)
+            Model channels. Each chunk is a newly allocated array, which consumers may overwrite.
+        """
         vel2d, int2d, linew2d, lineb2d = velocity2d, {}, {}, {}
-        int2d_shape = np.shape(velocity2d['upper'])
+        int2d_shape = np.shape(velocity2d['upper'])[-2:] #subpixel velocities have a leading axis
         
         if isinstance(intensity2d, numbers.Number):
             int2d['upper'] = int2d['lower'] = intensity2d
@@ -710,42 +954,71 @@ class Intensity:
         else:
             lineb2d = lineslope2d
 
-        """
-        if self.subpixels:
-            vel2d_near_nan = np.isnan(vel2d[self.sub_centre_id]['upper'])
-            vel2d_far_nan = np.isnan(vel2d[self.sub_centre_id]['lower'])
-        else:
-            vel2d_near_nan = np.isnan(vel2d['upper']) #~vel2d['upper'].mask
-            vel2d_far_nan = np.isnan(vel2d['lower']) #~vel2d['lower'].mask
-        """
+        vchannels = np.asarray(vchannels)
+        vchannels_dt = vchannels.astype(self.dtype) #avoids upcasting line profiles
+        nchan = len(vchannels)
+        nchunk = self._get_channel_chunk(int2d_shape)
+        executor = self._get_model_executor()
+        if executor is not None: #the memory budget is shared by the chunks in flight, at least one chunk per thread
+            nthreads = self.nthreads_model
+            nchunk = max(1, min(nchunk//nthreads, -(-nchan//nthreads)))
+
+        #Band-limited line profiles, only pixels within the profile half-width of each channel are evaluated, see _get_profile_halfwidth
+        sparse = self.line_profile_cutoff is not None and not self.subpixels
+        if sparse: bands = self._get_velocity_bands(vel2d, int2d, linew2d, lineb2d, **kwargs_line)
         
-        cube = []
-        noise = 0.0
-        #for _ in itertools.repeat(None, nchan):
-        for vchan in vchannels:
-            v_near, v_far = self.get_line_profile(vchan, vel2d, linew2d, lineb2d, **kwargs_line)
-            int2d_near = int2d['upper'] * v_near
-            int2d_far = int2d['lower'] * v_far
-            int2d_full = self.line_uplow(int2d_near, int2d_far) 
+        #Line profiles of nchunk channels are computed at once by broadcasting along a leading channel axis
+        def get_chunk(i0, i1):
+            noise = 0.0
+            if sparse:
+                v_near, v_far = self.get_line_profile_sparse(vchannels_dt[i0:i1], bands, **kwargs_line)
+            else:
+                vchan = vchannels_dt[i0:i1, None, None]
+                v_near, v_far = self.get_line_profile(vchan, vel2d, linew2d, lineb2d, **kwargs_line)
+                v_near = v_near * int2d['upper']
+                v_far = v_far * int2d['lower']
+            int2d_full = self.line_uplow(v_near, v_far)
             
             if rms is not None:
-                noise = np.random.normal(scale=rms, size=int2d_shape)
+                noise = np.random.normal(scale=rms, size=int2d_full.shape).astype(self.dtype)
                 int2d_full += noise
 
+            np.copyto(int2d_full, noise, where=~np.isfinite(int2d_full))
             if self.beam_kernel is not None:
                 if make_convolve:
-                    int2d_full[np.isnan(int2d_full)] = noise
-                    int2d_full = self.beam_area*convolve(int2d_full, self.beam_kernel, preserve_nan=False)
-                else:
-                    int2d_full *= self.beam_area
-                    int2d_full[~np.isfinite(int2d_full)] = noise
-            else:
-                int2d_full[~np.isfinite(int2d_full)] = noise
-                
-            cube.append(int2d_full)
+                    if self.convolution == 'fft':
+                        int2d_full = self._convolve_fft(int2d_full)
+                    else:
+                        int2d_full = np.array([convolve(chan, self.beam_kernel, preserve_nan=False) for chan in int2d_full], dtype=self.dtype)
+                int2d_full *= self.beam_area
+            return int2d_full
+
+        chunks = [(i0, min(i0+nchunk, nchan)) for i0 in range(0, nchan, nchunk)]
+        if executor is None:
+            for i0, i1 in chunks: yield i0, i1, get_chunk(i0, i1)
+        else: #Chunks are synthesised concurrently and yielded in order, keeping at most nthreads+1 of them in flight
+            pending = collections.deque()
+            for i0, i1 in chunks:
+                pending.append((i0, i1, executor.submit(get_chunk, i0, i1)))
+                if len(pending) > nthreads:
+                    i0, i1, future = pending.popleft()
+                    yield i0, i1, future.result()
+            while pending:
+                i0, i1, future = pending.popleft()
+                yield i0, i1, future.result()
+
+    def get_cube(self, vchannels, velocity2d, intensity2d, linewidth2d, lineslope2d, make_convolve=True,
+                 rms=None, tb={'nu': False, 'beam': False, 'full': True}, return_data_only=False, header=None, dpc=None, **kwargs_line):
+        
+        vchannels = np.asarray(vchannels)
+        int2d_shape = np.shape(velocity2d['upper'])[-2:]
+        cube = np.empty((len(vchannels),)+int2d_shape, dtype=self.dtype)
+        for i0, i1, chans in self.iter_cube(vchannels, velocity2d, intensity2d, linewidth2d, lineslope2d,
+                                            make_convolve=make_convolve, rms=rms, **kwargs_line):
+            cube[i0:i1] = chans
             
-        if return_data_only: return np.asarray(cube)
-        else: return Cube(np.asarray(cube), header, vchannels, dpc, beam=self.beam_info, filename="./cube_model.fits")
+        if return_data_only: return cube
+        else: return Cube(cube, header, vchannels, dpc, beam=self.beam_info, filename="./cube_model.fits")
 
     @staticmethod
     def make_channels_movie(vchan0, vchan1, velocity2d, intensity2d, linewidth2d, lineslope2d, nchans=30, folder='./movie_channels/', **kwargs):
@@ -803,8 +1076,11 @@ class Mcmc:
         return header, kind, len(header), boundaries_list, params_indices
     
     @staticmethod
-    def plot_walkers(samples, best_params, nstats=None, header=None, kind=None, tag=''):
+    def plot_walkers(samples, best_params, nstats=None, header=None, kind=None, tag='', thin=1):
+        #samples shape (npars, nsteps/thin, nwalkers), e.g. from emcee's get_chain(thin=thin). nstats and the x axis are in steps
         npars, nsteps, nwalkers = samples.shape
+        steps = thin*np.arange(nsteps) + thin-1
+        nsteps = nsteps*thin
         if kind is not None:
             ukind, neach = np.unique(kind, return_counts=True)
             ncols = len(ukind)
@@ -831,7 +1107,7 @@ class Mcmc:
                 if ncols == 1: axij = ax[i]
                 elif nrows==1: axij = ax[j]
                 else: axij = ax[i][j]
-                axij.plot(walker, alpha=0.1, lw=1.0, color='k')
+                axij.plot(steps, walker, alpha=0.1, lw=1.0, color='k')
                 if header is not None: 
                     #axij.set_ylabel(header[k])
                     axij.text(0.1, 0.1, header[k], va='center', ha='left', fontsize=MEDIUM_SIZE+2, transform=axij.transAxes, rotation=0) #0.06, 0.95, va top, rot 90
@@ -866,31 +1142,353 @@ class Mcmc:
         corner.corner(samples, labels=labels, title_fmt='.4f', bins=30,
                       quantiles=quantiles, show_titles=True)
     
+    def _check_convergence(self, sampler, autocorr, thin_by=1, factor=50, rtol=0.01):
+        #Estimate the autocorrelation time (in steps) of the stored chains, append it to autocorr, and return whether chains have converged
+        nstored = sampler.iteration
+        tau = thin_by * sampler.get_autocorr_time(tol=0, thin=max(1, nstored//1000)) #on at most ~1000 stored steps per walker
+        tau_prev = autocorr['tau'][-1] if autocorr['tau'] else np.inf
+        autocorr['steps'].append(nstored*thin_by)
+        autocorr['tau'].append(tau)
+        nsteps, tau_max = nstored*thin_by, np.max(tau)
+        dtau = np.max(np.abs(tau_prev - tau)/tau)
+        converged = bool(np.all(factor*tau < nsteps) and dtau < rtol)
+        print ('\nStep %d, max autocorrelation time %.1f steps (%s), chain length %.1f tau, tau change %.3g'%(nsteps, tau_max, self.mc_header[np.argmax(tau)], nsteps/tau_max, dtau))
+        if converged: 
+            print ('Chains converged (length > %g tau, tau change < %g), stopping at step %d'%(factor, rtol, nsteps))
+            autocorr['converged'] = True
+        return converged
+
+    @staticmethod
+    def _log_ndtr_interval(a, b):
+        #log(Phi(b) - Phi(a)) for b > a, Phi being the standard normal cdf. Stable far in the tails.
+        if a > 0: a, b = -b, -a
+        la, lb = log_ndtr(a), log_ndtr(b)
+        return lb + np.log1p(-np.exp(la - lb))
+
+    def _get_beam_lattice(self, shape, step=None):
+        """
+        Boolean mask of a square lattice of sky pixels spaced by step pixels, with one pixel on the grid centre.
+        If step is None, it is set to the square root of the beam area in pixels, i.e. one pixel per beam area.
+        """
+        if step is None:
+            if self.beam_area is None: raise InputError(step, 'The datacube has no beam, a lattice step in pixels must be given.')
+            step = np.sqrt(self.beam_area)
+        step = max(1, int(round(step)))
+        ny, nx = shape
+        lattice = np.zeros(shape, dtype=bool)
+        lattice[(ny//2)%step::step, (nx//2)%step::step] = True
+        return lattice
+        
+    def _prepare_mcmc(self, data, vchannels, noise_stddev, compact_threshold=0.5, lattice=None, mask=None, crop=False):
+        """
+        Precompute the data products read by the likelihood at each call: validity mask, zero-filled data and inverse-variance weights.
+        If the fraction of valid data pixels is below compact_threshold, only the valid pixels are stored, along with their flat indices.
+        Otherwise, non-finite data values are zero-filled in mc_data itself (on a copy of the input data), so that no second data cube is kept.
+        
+        noise_stddev can be a scalar, a noise map with shape (ny, nx), a per-channel noise with shape (nchan,), or a noise cube with the shape of the data.
+        Pixels with non-finite data, or non-finite or non-positive noise are excluded from the likelihood, as well as pixels outside lattice, if given (see _get_beam_lattice),
+        and voxels outside mask, if given (see make_keplerian_mask).
+        If crop, the contribution of pixels outside the model region of interest is added analytically from <data, data> (see _get_roi and ln_likelihood).
+        """
+        self.mc_data = np.asarray(data, dtype=self.dtype)
+        self.mc_vchannels = vchannels
+        self.mc_nchan = len(vchannels)
+        nchan, ny, nx = self.mc_data.shape
+        
+        noise = np.asarray(noise_stddev, dtype=np.float64)
+        if noise.ndim == 0: noise = noise.reshape(1, 1, 1)
+        elif noise.shape == (nchan,): noise = noise.reshape(nchan, 1, 1)
+        elif noise.shape == (ny, nx): noise = noise[None]
+        elif noise.shape != (nchan, ny, nx):
+            raise InputError(noise.shape, 'noise_stddev must be a scalar or have shape (nchan,)=%s, (ny, nx)=%s or (nchan, ny, nx)=%s'%((nchan,), (ny, nx), (nchan, ny, nx)))
+        self.noise_stddev = noise.squeeze().astype(self.dtype)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            inv_var = np.where(np.isfinite(noise) & (noise > 0), 1/noise**2, 0)
+        valid = np.isfinite(self.mc_data) & (inv_var > 0)
+        if lattice is not None: valid &= lattice
+        if mask is not None: valid &= mask.cube
+        mask = valid
+        chans = np.flatnonzero(mask.any(axis=(1, 2)))
+        self.mc_data_chans = (chans[0], chans[-1]+1) if chans.size else (0, 0) #channel range with valid voxels
+        inv_var = inv_var.astype(self.dtype)
+        self.mc_inv_var = inv_var.item() if inv_var.size == 1 else inv_var
+        self.mc_ndata = np.count_nonzero(mask)
+        
+        self.mc_data_S_dd = np.sum(np.square(self.mc_data)*inv_var, where=mask, dtype=np.float64) #<data, data>, see _ln_likelihood_linear
+        self.mc_compact = self.mc_ndata < compact_threshold*mask.size
+        if self.mc_compact:
+            index = np.flatnonzero(mask)
+            self.mc_data_index = index
+            self.mc_data_offsets = np.searchsorted(index, np.arange(nchan+1)*ny*nx)
+            self.mc_data_filled = self.mc_data.ravel()[index]
+            if np.ndim(self.mc_inv_var): self.mc_inv_var = np.broadcast_to(inv_var, mask.shape).ravel()[index]
+            self.mc_data_mask = None
+        else: #Voxels outside mask are excluded from all sums, but must be finite
+            self.mc_data_index = self.mc_data_offsets = None
+            finite = np.isfinite(self.mc_data)
+            if not finite.all():
+                if np.may_share_memory(self.mc_data, data): self.mc_data = np.where(finite, self.mc_data, 0).astype(self.dtype, copy=False)
+                else: self.mc_data[~finite] = 0
+            self.mc_data_filled = self.mc_data
+            self.mc_data_mask = mask
+        self.mc_data_weighted = self.mc_data_filled*self.mc_inv_var if self.mc_linear_amplitude else None
+        self.mc_crop = crop
+
+    def _get_data_chunk(self, i0, i1, model, roi=None):
+        """
+        Precomputed data products for channels i0:i1, and the model at the same pixels. 
+        If roi=(ys, xs), the model chunk only covers the sky region data[:, ys, xs].
+
+        Returns the zero-filled data, weighted data, weights, mask, and model.
+        """
+        if self.mc_compact:
+            j0, j1 = self.mc_data_offsets[i0], self.mc_data_offsets[i1]
+            index = self.mc_data_index[j0:j1] - i0*self.mc_data[0].size
+            if roi is None: sl = slice(j0, j1)
+            else: #Flat data indices within the region, mapped onto the flat indices of the cropped model chunk
+                ny, nx = self.mc_data.shape[-2:]
+                (y0, y1), (x0, x1) = [(s.start, s.stop) for s in roi]
+                chan, y, x = np.unravel_index(index, (i1-i0, ny, nx))
+                inside = np.flatnonzero((y >= y0) & (y < y1) & (x >= x0) & (x < x1))
+                index = np.ravel_multi_index((chan[inside], y[inside]-y0, x[inside]-x0), model.shape)
+                sl = j0 + inside
+            model, mask = np.take(model, index), True
+        else:
+            sl = (slice(i0, i1),) if roi is None else (slice(i0, i1),)+tuple(roi)
+            mask = self.mc_data_mask[sl]
+        w = self.mc_inv_var
+        if np.ndim(w) and w.size > 1: #slice only the non-broadcast axes of the weights
+            w = w[sl] if self.mc_compact else w[tuple(si if n > 1 else slice(None) for si, n in zip(sl, w.shape))]
+        get = lambda arr: arr[sl] if arr is not None else None
+        return get(self.mc_data_filled), get(self.mc_data_weighted), w, mask, model
+
+    def _get_roi(self, vel2d, linew2d, lineb2d):
+        """
+        Region of interest of the model in the sky and in velocity, outside of which model channels are zero. 
+
+        The sky region is the bounding box of the pixels where either emission surface is defined (i.e. within Rmax), 
+        padded by half the beam kernel size, as convolution spreads emission by that much, and rounded up to multiples of 8 pixels 
+        to limit the number of distinct FFT shapes. If line profiles are truncated (see line_profile_cutoff), 
+        channels further than the profile cut-off from the velocity range of the model are excluded too, 
+        as well as channels without valid data voxels (e.g. outside a Keplerian mask).
+
+        Returns
+        -------
+        c0, c1 : int
+            First and last (exclusive) channel indices of the region.
+
+        ys, xs : slice
+            Sky region.
+        """
+        ny, nx = self.mc_data.shape[-2:]
+        finite = {side: np.isfinite(vel2d[side]) for side in ['upper', 'lower']}
+        sky = np.zeros((ny, nx), dtype=bool)
+        for side in finite: sky |= finite[side] if finite[side].ndim == 2 else finite[side].any(axis=0) #subpixels
+        rows, cols = np.flatnonzero(sky.any(axis=1)), np.flatnonzero(sky.any(axis=0))
+        if not rows.size: return 0, 0, slice(0, 0), slice(0, 0)
+
+        my, mx = (0, 0) if self.beam_kernel is None else [n//2 for n in np.shape(getattr(self.beam_kernel, 'array', self.beam_kernel))]
+        def expand(lo, hi, n, q=8):
+            lo, hi = max(lo, 0), min(hi, n)
+            size = min(-(-(hi-lo)//q)*q, n)
+            lo = min(max(lo - (size-(hi-lo))//2, 0), n-size)
+            return slice(lo, lo+size)
+        ys = expand(rows[0]-my, rows[-1]+1+my, ny)
+        xs = expand(cols[0]-mx, cols[-1]+1+mx, nx)
+        
+        c0, c1 = 0, self.mc_nchan
+        if self.line_profile_cutoff is not None and not self.subpixels:
+            vel = np.concatenate([vel2d[side][finite[side]] for side in finite])
+            width = np.nanmax([np.nanmax(linew2d[side]) for side in finite])
+            b_slope = np.nanmin([np.nanmin(lineb2d[side]) for side in finite])
+            half = self._get_profile_halfwidth(width, b_slope=b_slope)
+            vchannels = np.asarray(self.mc_vchannels)
+            chans = np.flatnonzero((vchannels >= vel.min()-half) & (vchannels <= vel.max()+half))
+            c0, c1 = (chans[0], chans[-1]+1) if chans.size else (0, 0)
+        #No voxel outside the channel range of the data mask enters the likelihood
+        c0, c1 = max(c0, self.mc_data_chans[0]), min(c1, self.mc_data_chans[1])
+        return c0, c1, ys, xs
+
+    @staticmethod
+    def _weighted_sum(prod, w, mask):
+        #sum(w*prod) over valid pixels, in double precision. prod is overwritten
+        if np.ndim(w):
+            np.multiply(prod, w, out=prod)
+            return np.sum(prod, where=mask, dtype=np.float64)
+        return w*np.sum(prod, where=mask, dtype=np.float64)
+        
+    def _get_likelihood_workspace(self, shape, nchan):
+        #Residual buffer reused across the channel chunks of one likelihood call
+        if self.mc_compact or not nchan: return None
+        nchunk = min(self._get_channel_chunk(shape), nchan)
+        return np.empty((nchunk,)+tuple(shape), dtype=self.dtype)
+        
+    def _ln_likelihood_linear(self, chunks, work, c0=0, roi=None):
+        """
+        Log-likelihood of a model cube computed with I0=1, with the intensity amplitude I0 solved for analytically 
+        from the dot products <data, data>, <data, model> and <model, model>, accumulated over chunks of channels.
+
+        - If self.mc_linear_amplitude='profile', I0 is set to its best-fit value, clipped to the I0 boundaries.
+
+        - If 'marginalise', the likelihood is integrated over I0 assuming a flat prior within the I0 boundaries.
+
+        Returns the log-likelihood and the best-fit amplitude. 
+        """
+        S_dd = self.mc_data_S_dd
+        S_dm = S_mm = 0.0
+        for i0, i1, model in chunks:
+            _, data_w, w, mask, model = self._get_data_chunk(c0+i0, c0+i1, model, roi=roi)
+            prod = np.empty_like(model) if work is None else work[:i1-i0]
+            S_dm += np.sum(np.multiply(data_w, model, out=prod), where=mask, dtype=np.float64)
+            S_mm += self._weighted_sum(np.multiply(model, model, out=prod), w, mask)
+
+        lo, hi = self.mc_amplitude_bounds
+        if not S_mm > 0: #model is zero everywhere, amplitude is undetermined
+            return (-0.5*S_dd, np.nan) if np.isfinite(S_dd) else (-np.inf, np.nan)
+
+        amp = S_dm/S_mm
+        if self.mc_linear_amplitude == 'profile':
+            amp = min(max(amp, lo), hi)
+            lnx2 = -0.5*(S_dd - 2*amp*S_dm + amp**2*S_mm)
+        else:
+            sqrt_mm = np.sqrt(S_mm)
+            lnx2 = (-0.5*(S_dd - S_dm**2/S_mm) + 0.5*np.log(2*np.pi/S_mm) - np.log(hi-lo)
+                    + Mcmc._log_ndtr_interval((lo-amp)*sqrt_mm, (hi-amp)*sqrt_mm))
+            amp = min(max(amp, lo), hi)
+        return (lnx2, amp) if np.isfinite(lnx2) else (-np.inf, np.nan)
+        
+    def _get_shared_model(self, min_bytes=2**20):
+        """
+        Move the large arrays read by the likelihood (data products and disc grid coordinates) to shared memory.
+        Arrays aliased by several attributes (e.g. mc_data and datacube.data, or x_true and grid['x']) are exported once. 
+        Other large arrays, e.g. sky grid coordinates or the datacube data when it is not the fitted data, are not needed by workers and are dropped.
+
+        Returns
+        -------
+        model : copy of the model without those arrays, to be sent once to each worker process.
+
+        specs : list of (path, name, shape, dtype) to attach the arrays in workers, see _init_shared_worker. Aliased paths share the block name.
+
+        blocks : list of `~multiprocessing.shared_memory.SharedMemory`, to be closed and unlinked by the caller when the workers are done.
+        """
+        needed = ['mc_data', 'mc_data_filled', 'mc_data_mask', 'mc_data_weighted', 'mc_inv_var', 'mc_data_index', 'mc_data_offsets',
+                  'x_true', 'y_true', 'R_true', 'phi_true', 'sub_x_true', 'sub_y_true', 'sub_R_true', 'sub_phi_true', 'R_1d']
+        layout = lambda arr: (arr.__array_interface__['data'][0], arr.shape, arr.strides, arr.dtype.str) #identical views of the same memory
+        needed = {layout(val) for val in (getattr(self, key, None) for key in needed) if isinstance(val, np.ndarray)}
+        
+        paths = [(key,) for key, val in vars(self).items() if isinstance(val, np.ndarray)]
+        paths += [(attr, key) for attr in ['grid', 'skygrid'] for key, val in getattr(self, attr).items() if isinstance(val, np.ndarray)]
+        paths += [('datacube', 'data')]
+        model = copy.copy(self)
+        specs, blocks, exported = [], [], {}
+        for path in paths:
+            obj = self
+            for key in path: obj = obj[key] if isinstance(obj, dict) else getattr(obj, key)
+            arr = np.asarray(obj)
+            if arr.nbytes < min_bytes: continue
+            mem = layout(arr)
+            if mem in exported: specs.append((path, exported[mem], arr.shape, arr.dtype.str))
+            elif mem in needed:
+                shm = SharedMemory(create=True, size=arr.nbytes)
+                blocks.append(shm)
+                np.ndarray(arr.shape, dtype=arr.dtype, buffer=shm.buf)[...] = arr
+                specs.append((path, shm.name, arr.shape, arr.dtype.str))
+                exported[mem] = shm.name
+            if len(path) > 1 and getattr(model, path[0]) is getattr(self, path[0]): #copy containers before stripping their arrays
+                parent = getattr(self, path[0])
+                if isinstance(parent, dict): setattr(model, path[0], dict(parent))
+                else: #methods bound to the original object (e.g. Cube.interactive) would pickle it whole
+                    parent_copy = copy.copy(parent)
+                    for key, val in vars(parent_copy).items():
+                        if isinstance(val, types.MethodType) and val.__self__ is parent: setattr(parent_copy, key, types.MethodType(val.__func__, parent_copy))
+                    setattr(model, path[0], parent_copy)
+            _set_path(model, path, None)
+        return model, specs, blocks
+        
+    def _sort_walkers(self, params_batch):
+        #Order walkers by their orientation and height parameters, so that consecutive evaluations share geometry (plans and attribute caches)
+        geom = [i for i in range(self.mc_nparams) if self.mc_kind[i] in ['orientation', 'height_upper', 'height_lower']]
+        if not geom: return np.arange(len(params_batch))
+        return np.lexsort(params_batch[:, geom[::-1]].T)
+
+    def _clone(self):
+        #Shallow copy for thread-level parallelism: own parameters and caches, shared data and grids
+        clone = copy.copy(self)
+        clone.params = copy.deepcopy(self.params)
+        for attr in ['_plan_cache', '_stage_cache', '_log_coords_cache', '_beam_fft_cache']:
+            setattr(clone, attr, LRUCache(maxsize=getattr(self, attr).maxsize))
+        return clone
+    
+    def ln_likelihood_batch(self, params_batch, models=None, map_func=None, **kwargs):
+        """
+        Log-likelihood of a batch of walkers, e.g. for samplers initialised with vectorize=True.
+
+        Walkers are sorted by their orientation and height parameters, so that walkers with the same geometry are evaluated 
+        consecutively and reuse reprojection plans and projected attributes. The batch is split in as many contiguous chunks as models.
+
+        Parameters
+        ----------
+        params_batch : array_like, shape (nwalkers, ndim)
+            Parameters of each walker.
+
+        models : list of `~discminer.disc2d.Model`, optional
+            Model instances on which chunks are evaluated. Defaults to [self]. For thread-level parallelism these must be independent clones (see run_mcmc).
+
+        map_func : callable, optional
+            Map function to evaluate chunks in parallel, e.g. ThreadPoolExecutor.map or Pool.map. Defaults to the built-in map.
+
+        Returns
+        -------
+        lnx2 : array_like, shape (nwalkers,), or (nwalkers, 2) if self.mc_linear_amplitude is set, the second column being the best-fit amplitude.
+        """
+        params_batch = np.atleast_2d(params_batch)
+        if models is None: models = [self]
+        if map_func is None: map_func = map
+        order = self._sort_walkers(params_batch)
+        chunks = [chunk for chunk in np.array_split(order, len(models)) if len(chunk)]
+        results = map_func(_ln_likelihood_chunk, [(model, params_batch[chunk], kwargs) for model, chunk in zip(models, chunks)])
+        lnx2 = np.empty((len(params_batch), 2) if self.mc_linear_amplitude else len(params_batch))
+        lnx2[np.concatenate(chunks)] = [res for chunk_res in results for res in chunk_res]
+        return lnx2
+
     def ln_likelihood(self, new_params, **kwargs):
         for i in range(self.mc_nparams):
-            if not (self.mc_boundaries_list[i][0] < new_params[i] < self.mc_boundaries_list[i][1]): return -np.inf
+            if not (self.mc_boundaries_list[i][0] < new_params[i] < self.mc_boundaries_list[i][1]): 
+                return (-np.inf, np.nan) if self.mc_linear_amplitude else -np.inf
             else: self.params[self.mc_kind[i]][self.mc_header[i]] = new_params[i]
 
         vel2d, int2d, linew2d, lineb2d = self.make_model(**kwargs)
 
-        lnx2=0    
-        model_cube = self.get_cube(self.mc_vchannels, vel2d, int2d, linew2d, lineb2d, return_data_only=True)
-        for i in range(self.mc_nchan):
-            model_chan = model_cube[i]
-            mask_data = np.isfinite(self.mc_data[i])
-            mask_model = np.isfinite(model_chan)
-            data = np.where(np.logical_and(mask_model, ~mask_data), 0, self.mc_data[i])
-            model = np.where(np.logical_and(mask_data, ~mask_model), 0, model_chan)
-            mask = np.logical_and(mask_data, mask_model)
-            lnx =  np.where(mask, np.power((data - model)/self.noise_stddev, 2), 0) 
-            lnx2 += -0.5 * np.sum(lnx)
+        #The chi-squared is accumulated while channels are synthesised, the model cube is never held in memory.
+        # Model channels are always finite, non-finite pixels are zero-filled before convolution in iter_cube
+        props = [vel2d, int2d, linew2d, lineb2d]
+        c0, c1, roi = 0, self.mc_nchan, None
+        if self.mc_crop: #Synthesise only the region where the model has emission, see _get_roi
+            c0, c1, *roi = self._get_roi(vel2d, linew2d, lineb2d)
+            props = [{side: prop[side][..., roi[0], roi[1]] if np.ndim(prop[side]) >= 2 else prop[side] for side in prop} for prop in props]
+        shape = np.shape(props[0]['upper'])[-2:]
+        empty = c1 <= c0 or not np.prod(shape)
+        chunks = iter(()) if empty else self.iter_cube(self.mc_vchannels[c0:c1], *props)
+        work = self._get_likelihood_workspace(shape, 0 if empty else c1-c0)
+        if self.mc_linear_amplitude: return self._ln_likelihood_linear(chunks, work, c0=c0, roi=roi)
+
+        lnx2 = S_dd = 0
+        for i0, i1, model in chunks:
+            data, _, w, mask, model = self._get_data_chunk(c0+i0, c0+i1, model, roi=roi)
+            res = model if work is None else work[:i1-i0]
+            np.subtract(data, model, out=res)
+            np.multiply(res, res, out=res)
+            lnx2 += -0.5 * self._weighted_sum(res, w, mask) #accumulate in double precision
+            if self.mc_crop: S_dd += self._weighted_sum(np.square(data, out=res), w, mask) #<data, data> within the region, reusing the residual buffer
+        if self.mc_crop: lnx2 += -0.5 * (self.mc_data_S_dd - S_dd) #model is zero outside the region of interest
             
         return lnx2 if np.isfinite(lnx2) else -np.inf
     
 
 class Model(Height, Velocity, Intensity, Linewidth, Lineslope, GridTools, Mcmc):
     
-    def __init__(self, datacube, Rmax, Rmin=1.0, prototype=False, subpixels=False, write_extent=True):        
+    def __init__(self, datacube, Rmax, Rmin=1.0, prototype=False, subpixels=False, write_extent=True, projection='interpolate', plan_cache_size=4, dtype=np.float64, stage_cache_size=1):        
         """
         Initialise discminer model object.
 
@@ -915,6 +1513,25 @@ class Model(Height, Velocity, Intensity, Linewidth, Lineslope, GridTools, Mcmc):
         subpixels : bool, optional
             Subdivide original grid pixels into smaller pixels (subpixels) to account for large velocity gradients in the disc. This allows for more precise calculations of line-of-sight velocities in regions where velocity gradients across individual pixels can be large, e.g. near the centre of the disc. Defaults to False.
 
+        projection : str, optional
+            Method to map the disc attributes onto the sky grid.
+
+            - If 'interpolate' (default), attributes are computed on the disc grid, projected on the sky, and linearly interpolated onto the sky grid.
+
+            - If 'inverse', the disc coordinates where the line of sight of each sky pixel intersects the emission surfaces are solved for directly with vectorised Newton iterations, and attributes are evaluated on those exact coordinates. This avoids the triangulation of the projected disc grid and is normally several times faster. It assumes that each line of sight intersects each emission surface only once, i.e. incl + surface opening angle < 90 deg.
+
+        plan_cache_size : int, optional
+            Number of sky-plane reprojection plans (see `~discminer.grid.ReprojectionPlan`) to keep in memory for each emission surface. A plan is reused as long as the orientation and height parameters of the surface do not change, which skips the triangulation of the projected disc grid when only intensity, line width or line slope parameters are modified. Defaults to 4.
+
+            plan_cache_size also sets the size of the cache of log(R) and log|z| of each surface, but not that of projected attributes (see stage_cache_size).
+
+        dtype : data-type, optional
+            Floating-point precision of the model grids, attributes, channel maps and likelihood residuals. Use np.float32 to halve the memory footprint and traffic of the forward model, e.g. to fit more parallel workers per node. The chi-squared is always accumulated in double precision. Defaults to np.float64.
+
+        stage_cache_size : int, optional
+            Number of projected attribute maps (velocity, intensity, line width and line slope of both surfaces) to keep in memory for each attribute, so that make_model only recomputes the attributes whose parameters, or the orientation and heights they depend on, have changed. Cached attribute maps are returned as read-only arrays. 
+            Each entry holds two full-size sky maps, and entries are only reused if none of those parameters change, e.g. in a fit with free orientation they are rarely hit. Set to 0 to disable. Defaults to 1.
+
         Attributes
         ----------
         skygrid : dict
@@ -928,8 +1545,9 @@ class Model(Height, Velocity, Intensity, Linewidth, Lineslope, GridTools, Mcmc):
         FrontendUtils._print_logo()        
         self.prototype = prototype
         self.datacube = datacube
+        self.dtype = np.dtype(dtype)
         
-        mgrid = ModelGrid(datacube, Rmax, Rmin=Rmin, write_extent=write_extent) #Make disc and sky grids
+        mgrid = ModelGrid(datacube, Rmax, Rmin=Rmin, write_extent=write_extent, dtype=self.dtype) #Make disc and sky grids
         grid = mgrid.discgrid        
         skygrid = mgrid.skygrid
 
@@ -961,6 +1579,11 @@ class Model(Height, Velocity, Intensity, Linewidth, Lineslope, GridTools, Mcmc):
         self._compute_prop = _compute_prop_standard
         self._use_temperature = False
         self._use_full_channel = False
+        self._memory_budget = 16 #MB, see get_cube
+        self._convolution = 'fft' #or 'astropy'
+        self._fft_workers = 1
+        self._nthreads_model = 1 #see _get_model_executor
+        self._line_profile_cutoff = None #dense line profiles
  
         x_true, y_true = grid['x'], grid['y']
         self.x_true, self.y_true = x_true, y_true
@@ -971,8 +1594,15 @@ class Model(Height, Velocity, Intensity, Linewidth, Lineslope, GridTools, Mcmc):
         self.skygrid = skygrid
         self.extent = skygrid['extent']
         self.projected_coords = None #computed in get_projected_coords
+        if projection not in ['interpolate', 'inverse']:
+            raise InputError(projection, "projection must be 'interpolate' or 'inverse'")
+        self.projection = projection
+        self._plan_cache = LRUCache(maxsize=2*plan_cache_size) #upper and lower surface plans
+        self._stage_cache = LRUCache(maxsize=4*stage_cache_size) #projected attributes, see make_model
+        self._log_coords_cache = LRUCache(maxsize=2*plan_cache_size) #log(R) and log|z| of each surface
     
         self.R_1d = None #modified if selfgravity is considered
+        self.mc_linear_amplitude = None #see run_mcmc
 
         if subpixels and isinstance(subpixels, int):
             if subpixels%2 == 0: subpixels+=1 #Force it to be odd to contain parent pix centre
@@ -980,19 +1610,21 @@ class Model(Height, Velocity, Intensity, Linewidth, Lineslope, GridTools, Mcmc):
             dx = dy = pix_size / subpixels
             centre = int(round((subpixels-1)/2.))
             centre_sq = int(round((subpixels**2-1)/2.))
-            x_shift = np.arange(0, subpixels*dx, dx) - dx*centre
-            y_shift = np.arange(0, subpixels*dy, dy) - dy*centre
-            sub_x_true = [x_true + x0 for x0 in x_shift]
-            sub_y_true = [y_true + y0 for y0 in y_shift]
-            self.sub_R_true = [[hypot_func(sub_x_true[j], sub_y_true[i]) for j in range(subpixels)] for i in range(subpixels)]
-            self.sub_phi_true = [[np.arctan2(sub_y_true[i], sub_x_true[j]) for j in range(subpixels)] for i in range(subpixels)]
-            self.sub_x_true = sub_x_true
-            self.sub_y_true = sub_x_true
+            x_shift = (np.arange(subpixels) - centre)*dx
+            y_shift = (np.arange(subpixels) - centre)*dy
+            #Stacked subpixel coordinates, shape (subpixels**2, ncells). Subpixel i*subpixels+j is shifted by (x_shift[j], y_shift[i])
+            sub_x_shift, sub_y_shift = [xy.reshape(-1, 1).astype(self.dtype) for xy in np.meshgrid(x_shift, y_shift)]
+            self.sub_x_true = x_true[None] + sub_x_shift
+            self.sub_y_true = y_true[None] + sub_y_shift
+            self.sub_R_true = hypot_func(self.sub_x_true, self.sub_y_true)
+            self.sub_phi_true = np.arctan2(self.sub_y_true, self.sub_x_true)
             self.sub_dA = dx*dy
             self.pix_dA = pix_size**2
             self.sub_centre_id = centre_sq
             self.subpixels = subpixels
             self.subpixels_sq = subpixels**2
+            if projection=='inverse':
+                raise InputError(subpixels, "subpixels are only available for projection='interpolate'")
         else: self.subpixels=False
 
         #Initialise and print default parameters for default functions
@@ -1051,6 +1683,12 @@ class Model(Height, Velocity, Intensity, Linewidth, Lineslope, GridTools, Mcmc):
             #print ('Default parameter header for mcmc fitting:', self.mc_header)
             #print ('Default parameters to fit and fixed parameters:', self.mc_params)
 
+    def __getstate__(self):
+        #The sampler of a previous run holds its pool, which cannot be pickled, e.g. to send the model to workers of a new run
+        state = self.__dict__.copy()
+        state.pop('mc_sampler', None)
+        return state
+
     def plot_quick_attributes(self, R_in=10, R_out=300, surface='upper', fig_width=80, fig_height=25,
                               height=True, velocity=True, linewidth=True, peakintensity=True, **kwargs_plot):                              
         import termplotlib as tpl  # pip install termplotlib. Requires gnuplot: brew install gnuplot (for OSX users)
@@ -1080,6 +1718,13 @@ class Model(Height, Velocity, Intensity, Linewidth, Lineslope, GridTools, Mcmc):
                  z_mirror=False, 
                  plot_walkers=True, plot_corner=True, tag='',
                  mpi=False,
+                 linear_amplitude=None,
+                 vectorize=False, batch_parallel='processes',
+                 decimate=False, crop=True, keplerian_mask=None,
+                 shared_memory=False, nthreads_model=None,
+                 checkpoint=None, thin_by=1, chain_dtype=None,
+                 summary_every=None,
+                 autocorr_every=None, autocorr_factor=50, autocorr_rtol=0.01,
                  **kwargs_model): 
         """
         Optimise the discminer model parameters using an MCMC sampler.
@@ -1102,37 +1747,145 @@ class Model(Height, Velocity, Intensity, Linewidth, Lineslope, GridTools, Mcmc):
         
         frac_stats : float
             Fraction of MCMC steps at the end of the parameter chains considered for the computation of best-fit parameters (Defaults to 0.2, i.e. 20).
+
+        noise_stddev : float or array_like, optional
+            Standard deviation of the noise in the data. It can be a scalar (default 1.0), a noise map with shape (nx, nx), 
+            a per-channel noise with shape (nchan,), or a cube with the shape of the data. The data mask and inverse-variance weights are computed once before sampling.
+
+        linear_amplitude : None, 'profile' or 'marginalise', optional
+            Solve for the intensity amplitude I0 analytically instead of sampling it. The model cube is linear in I0, as long as the intensity function is proportional to it.
+            I0 is removed from the sampled parameters; if p0_mean (or frac_stddev) includes it, the corresponding entry is dropped. 
+
+            - If 'profile', the likelihood is evaluated at the best-fit I0 for each walker position.
+
+            - If 'marginalise', the likelihood is integrated over I0 assuming a flat prior within the I0 boundaries.
+
+            In both cases the best-fit I0 at each step is stored as an emcee blob and summarised in the attributes mc_amplitude_samples, best_amplitude, and best_fit_dict.
+
+        vectorize : bool, optional
+            If True, the sampler hands all walkers of a step at once to `~discminer.disc2d.Mcmc.ln_likelihood_batch`, instead of dispatching one likelihood call per walker. Defaults to False.
+
+        batch_parallel : None, 'processes' or 'threads', optional
+            How the batch of walkers is split when vectorize=True. 
+
+            - If 'processes' (default), in nthreads contiguous chunks mapped onto the process pool (or the MPI pool if mpi=True). The model is sent once per chunk rather than once per walker.
+
+            - If 'threads', in nthreads chunks evaluated by threads of the main process on independent model clones. No process pool is created. 
+
+            - If None, walkers are evaluated serially in the main process.
+
+        decimate : bool or float, optional
+            Evaluate the likelihood only on a lattice of approximately independent sky pixels, rather than on all the (beam-correlated) pixels of the data. 
+
+            - If True, the lattice step is the square root of the beam area in pixels, i.e. one pixel per beam area.
+
+            - If float, lattice step in pixels.
+
+            The model channels are still computed on the full grid, as they must be convolved with the beam. Defaults to False.
+
+        crop : bool, optional
+            If True (default), model channels are synthesised, convolved, and compared to the data only within the region where the model has emission 
+            (the bounding box of the projected disc, padded by the beam kernel and, if line_profile_cutoff is set, the range of channels reached by the line profiles).
+            The contribution of the data outside this region is added analytically.
+
+        keplerian_mask : `~discminer.tools.utils.KeplerianMask`, optional
+            Mask of the voxels to be included in the likelihood, e.g. from `~discminer.disc2d.Model.make_keplerian_mask`. 
+            If crop=True, channels outside the mask are not synthesised either.
+
+        shared_memory : bool, optional
+            If True, the precomputed data products and the model grids read by the likelihood are placed in shared memory once (see _get_shared_model), 
+            and each process of the pool attaches them at start-up. The rest of the model is sent once per process, and tasks only carry parameter vectors. 
+            Otherwise, the whole model is pickled along with each task. Applies only to the multiprocessing pool (mpi=False). Defaults to False.
+
+        nthreads_model : int or 'auto', optional
+            Number of threads used by each process of the pool (or MPI rank) to compute its models, see `~discminer.disc2d.Intensity.nthreads_model`.
+            Combined with mpi=True this runs a hybrid scheme, with few ranks across walkers (e.g. one per socket or NUMA domain) and a team of threads 
+            within each model, so that the number of model copies per node scales with the number of ranks rather than the number of cores. 
+            The number of ranks is set by the MPI launcher, e.g. ``mpirun -n 3 --map-by socket --bind-to socket`` on a two-socket node (the master rank only dispatches walkers).
+            Use it along with vectorize=True, so that walkers are split into one contiguous chunk per rank and the model is sent once per rank and step.
+
+            - If 'auto', the cores available to each rank (its CPU affinity) if mpi=True, or the cores of the machine divided by the number of processes (or batch threads) otherwise.
+
+            - If None (default), the current nthreads_model of the model is kept.
+
+        checkpoint : str, optional
+            Name of an HDF5 file where the chains are stored while sampling (emcee only, requires h5py). The file is updated every time a step is stored. 
+            If the file already holds chains (e.g. from a killed job), sampling resumes from its last stored step, and nsteps is then the total number of steps of the chains. 
+            The chains are stored under the group name tag (or 'mcmc'). Cannot be combined with backend.
+
+            After sampling, only the last frac_stats of the chains is read to compute the best-fit parameters, 
+            and the attributes holding the whole chains (mc_samples_all, mc_amplitude_samples_all) are not set; read them from the file or with self.mc_sampler.get_chain().
+
+        thin_by : int, optional
+            Store only one every thin_by steps of the chains. nsteps is still the number of steps taken by the walkers. Defaults to 1.
+
+        chain_dtype : data-type, optional
+            Data type of the stored chains and log-probabilities, e.g. np.float32 to halve their memory (or disk) footprint. Defaults to float64 (emcee only).
+
+        summary_every : int, optional
+            While sampling, the attribute mc_summary (`~discminer.tools.utils.OnlineSummary`) keeps running estimates of the median and errors of each parameter 
+            over the stored steps of the last frac_stats of the chains, and the acceptance fractions of the walkers, without copying the chains. 
+            If summary_every is set, these are printed every summary_every stored steps (emcee only, the summary is filled after sampling with zeus).
+
+        autocorr_every : int, optional
+            Monitor the convergence of the chains every autocorr_every stored steps, and stop sampling once they have converged (emcee only). 
+            The chains are considered converged when their length exceeds autocorr_factor times the integrated autocorrelation time (tau) of every parameter, 
+            and tau has changed by less than a fraction autocorr_rtol since the previous estimate. nsteps is then the maximum number of steps.
+            tau is estimated with emcee's get_autocorr_time on the stored chains, thinned to at most 1000 steps per walker.
+            The estimates are stored in the attribute mc_autocorr, a dictionary with the 'steps' at which tau was computed, 'tau' (in steps), and whether the chains 'converged'.
+            If sampling stops early, the best-fit parameters are computed over the last frac_stats of the chains actually taken.
+
+        autocorr_factor : float, optional
+            Minimum chain length, in units of tau, for convergence. Defaults to 50.
+
+        autocorr_rtol : float, optional
+            Maximum relative change of tau between consecutive estimates for convergence. Defaults to 0.01.
        
         """        
         if data is None and vchannels is None:
-            self.mc_data = self.datacube.data
-            self.mc_vchannels = self.vchannels
-        elif data is not None and vchannels is not None:
-            self.mc_data = data
-            self.mc_vchannels = vchannels
-        else:
+            data, vchannels = self.datacube.data, self.vchannels
+        elif data is None or vchannels is None:
             raise InputError((data, vchannels),
                              'Please specify both data AND vchannel slices you wish to consider for the MCMC sampling.')
             
-        self.mc_nchan = len(vchannels)
-        self.noise_stddev = noise_stddev
         if use_zeus: import zeus as sampler_id
         else: import emcee as sampler_id
             
         kwargs_model.update({'z_mirror': z_mirror})
         if z_mirror: 
             for key in self.mc_params['height_lower']: self.mc_params['height_lower'][key] = 'height_upper_mirror'
-        self.mc_header, self.mc_kind, self.mc_nparams, self.mc_boundaries_list, self.mc_params_indices = Model._get_params2fit(self.mc_params, self.mc_boundaries)
-        self.params = copy.deepcopy(self.mc_params)
+
+        if linear_amplitude not in [None, 'profile', 'marginalise']:
+            raise InputError(linear_amplitude, "linear_amplitude must be None, 'profile' or 'marginalise'")
+        self.mc_linear_amplitude = linear_amplitude
+        mc_params = self.mc_params
+        if linear_amplitude:
+            header_full, kind_full = Model._get_params2fit(self.mc_params, self.mc_boundaries)[:2]
+            self.mc_amplitude_bounds = self.mc_boundaries['intensity']['I0']
+            mc_params = copy.deepcopy(self.mc_params) #the user's mc_params are left untouched
+            mc_params['intensity']['I0'] = 1.0 #model is computed for unit amplitude, see _ln_likelihood_linear
+            if 'I0' in header_full: #drop I0 from initial guesses given for all the original parameters
+                i_amp = list(zip(kind_full, header_full)).index(('intensity', 'I0'))
+                if np.size(p0_mean) == len(header_full): p0_mean = np.delete(p0_mean, i_amp)
+                if np.size(frac_stddev) == len(header_full): frac_stddev = np.delete(frac_stddev, i_amp)
+                
+        self.mc_header, self.mc_kind, self.mc_nparams, self.mc_boundaries_list, self.mc_params_indices = Model._get_params2fit(mc_params, self.mc_boundaries)
+        self.params = copy.deepcopy(mc_params)
+        lattice = None
+        if decimate is not False and decimate is not None:
+            lattice = self._get_beam_lattice(np.shape(data)[-2:], step=None if decimate is True else decimate)
+        self._prepare_mcmc(data, vchannels, noise_stddev, lattice=lattice, mask=keplerian_mask, crop=crop)
 
         if isinstance(p0_mean, (list, tuple, np.ndarray)): 
             if len(p0_mean) != self.mc_nparams: raise InputError(p0_mean, 'Length of input p0_mean must be equal to the number of parameters to fit: %d'%self.mc_nparams)
             else: pass
 
-        nstats = int(round(frac_stats*(nsteps-1)))
+        if thin_by < 1 or thin_by > nsteps: raise InputError(thin_by, 'thin_by must be an integer between 1 and nsteps')
+        nstore = nsteps//thin_by #number of stored steps
+        nstats = max(1, int(round(frac_stats*(nstore-1)))) #stored steps considered for statistics
         ndim = self.mc_nparams
 
-        p0_stddev = [frac_stddev*(self.mc_boundaries_list[i][1] - self.mc_boundaries_list[i][0]) for i in range(self.mc_nparams)]
+        p0_stddev = np.asarray(frac_stddev)*[(self.mc_boundaries_list[i][1] - self.mc_boundaries_list[i][0]) for i in range(self.mc_nparams)]
         p0 = np.random.normal(loc=p0_mean,
                               scale=p0_stddev,
                               size=(nwalkers, ndim)
@@ -1154,7 +1907,7 @@ class Model(Height, Velocity, Intensity, Linewidth, Lineslope, GridTools, Mcmc):
         else:
             print ('Parameter header set for mcmc model fitting:', self.mc_header)
             print ('Parameters to fit and fixed parameters:')
-            pprint.pprint(self.mc_params)
+            pprint.pprint(mc_params)
             print ('Number of mc parameters:', self.mc_nparams)
             print ('Parameter attributes:', self.mc_kind)
             print ('Parameter boundaries:')
@@ -1163,68 +1916,144 @@ class Model(Height, Velocity, Intensity, Linewidth, Lineslope, GridTools, Mcmc):
             print ('p0 pars stddev:', p0_stddev)
         _break_line(init='\n', end='\n\n')
 
+        if batch_parallel not in [None, 'processes', 'threads']:
+            raise InputError(batch_parallel, "batch_parallel must be None, 'processes' or 'threads'")
+
+        if autocorr_every is not None and use_zeus: raise InputError(autocorr_every, 'The convergence monitor is only available for emcee samplers')
+        if checkpoint is not None: 
+            if use_zeus: raise InputError(checkpoint, 'Checkpointing is only available for emcee samplers')
+            if backend is not None: raise InputError((checkpoint, backend), 'Please provide either a checkpoint file or an emcee backend, not both')
+            backend = sampler_id.backends.HDFBackend(checkpoint, name=tag or 'mcmc', dtype=chain_dtype)
+            print ('Storing chains in %s, %d steps found'%(checkpoint, backend.iteration*thin_by if backend.initialized else 0))
+        elif backend is None and chain_dtype is not None and not use_zeus:
+            backend = sampler_id.backends.Backend(dtype=chain_dtype)
+
+        def run_sampler(sampler):
+            #Run or resume the chains. Checkpoint files resume until the chains have nsteps steps in total
+            resume = backend is not None and backend.iteration != 0
+            nrun = nstore - backend.iteration if checkpoint is not None and resume else nstore
+            kwargs_run = {'thin_by': thin_by} if thin_by > 1 else {}
+            #Running summary of the statistics window, i.e. the last nstats stored steps
+            nonlocal nstats
+            summary = self.mc_summary = OnlineSummary(nwalkers, ndim)
+            iter0 = backend.iteration if resume and checkpoint is None else 0
+            window = iter0 + nstore - nstats
+            autocorr = self.mc_autocorr = {'steps': [], 'tau': [], 'converged': False}
+            if resume and backend.iteration > window: 
+                for coords in backend.get_chain(discard=window): summary.update(coords)
+            start = time.time()
+            if nrun > 0 and use_zeus: 
+                sampler.run_mcmc(None if resume else p0, nrun, progress=True, **kwargs_run)
+                for coords in sampler.get_chain(discard=window): summary.update(coords)
+            elif nrun > 0:
+                for state in sampler.sample(sampler.get_last_sample() if resume else p0, iterations=nrun, progress=True, **kwargs_run):
+                    summary.update(state.coords, quantiles=sampler.iteration > window)
+                    if summary_every and not sampler.iteration % summary_every:
+                        print ('\nStep %d, mean acceptance fraction %.3f'%(sampler.iteration*thin_by, np.mean(summary.acceptance_fraction)))
+                        if summary.quantiles.count: 
+                            print ('Running median [-err, +err]:', ', '.join('%s=%.4g [-%.2g, +%.2g]'%val for val in zip(self.mc_header, summary.median, summary.errneg, summary.errpos)))
+                    if autocorr_every and not sampler.iteration % autocorr_every and self._check_convergence(sampler, autocorr, thin_by, autocorr_factor, autocorr_rtol):
+                        nstats = max(1, int(round(frac_stats*(sampler.iteration-iter0-1)))) #statistics over the chains actually taken
+                        if sampler.iteration <= window: 
+                            warnings.warn('Chains stopped at stored step %d, before the statistics window (from step %d). The quantiles of mc_summary are computed from the last %d stored steps'%(sampler.iteration, window, nstats))
+                        summary.reset_quantiles(sampler.get_chain(discard=sampler.iteration-nstats).reshape(-1, ndim)) #the window moved with nstats
+                        break
+            return time.time() - start
+
+        use_pool = not vectorize or batch_parallel == 'processes'
+        shared = shared_memory and use_pool and not mpi
+
+        if nthreads_model is not None: #Hybrid parallelism, the models of each process (or rank) are computed by a team of threads
+            nprocs = 1 if mpi or not (use_pool or batch_parallel == 'threads') else nthreads or os.cpu_count()
+            self.nthreads_model = _get_threads_per_process(nthreads_model, nprocs)
+
+        def get_sampler(pool):
+            if not vectorize:
+                log_prob = _ln_likelihood_shared if shared else self.ln_likelihood
+                return sampler_id.EnsembleSampler(nwalkers, ndim, log_prob, pool=pool, backend=backend, kwargs=kwargs_model)
+            if batch_parallel == 'processes' and pool is not None:
+                nchunks = getattr(pool, '_processes', None) or getattr(pool, 'size', None) or os.cpu_count()
+                models, map_func = [None if shared else self]*nchunks, pool.map
+            elif batch_parallel == 'threads':
+                nchunks = nthreads or os.cpu_count()
+                models, map_func = [self] + [self._clone() for i in range(nchunks-1)], executor.map
+            else: 
+                models, map_func = [self], None
+            log_prob = functools.partial(self.ln_likelihood_batch, models=models, map_func=map_func, **kwargs_model)
+            return sampler_id.EnsembleSampler(nwalkers, ndim, log_prob, backend=backend, vectorize=True)
+
+        executor = ThreadPoolExecutor(max_workers=nthreads) if vectorize and batch_parallel == 'threads' else contextlib.nullcontext()
+        
         if mpi: #Needs schwimmbad library: $ pip install schwimmbad 
             from schwimmbad import MPIPool
 
-            with MPIPool() as pool:
+            with MPIPool() as pool, executor:
                 if not pool.is_master():
                     pool.wait()
                     sys.exit(0)
+
+                print('MPI pool with %d worker ranks, %d model thread(s) per rank'%(pool.size, self.nthreads_model))
+                if vectorize and batch_parallel == 'processes' and nwalkers//2 < pool.size: #emcee moves half of the walkers at a time
+                    warnings.warn('Only %d walkers are evaluated at once, %d MPI ranks will be idle. Consider fewer ranks and more nthreads_model'%(nwalkers//2, pool.size-nwalkers//2))
                
-                sampler = sampler_id.EnsembleSampler(nwalkers, ndim, self.ln_likelihood, pool=pool, backend=backend, kwargs=kwargs_model)                                                        
-                start = time.time()
-                if backend is not None and backend.iteration!=0:
-                    sampler.run_mcmc(None, nsteps, progress=True)
-                else:
-                    sampler.run_mcmc(p0, nsteps, progress=True)
-                end = time.time()
-                multi_time = end - start
+                sampler = get_sampler(pool)
+                multi_time = run_sampler(sampler)
                 print("MPI multiprocessing took {0:.1f} seconds".format(multi_time))
 
         else:
-            with Pool(processes=nthreads) as pool:
-                sampler = sampler_id.EnsembleSampler(nwalkers, ndim, self.ln_likelihood, pool=pool, backend=backend, kwargs=kwargs_model)                                                        
-                start = time.time()
-                if backend is not None and backend.iteration!=0:
-                    sampler.run_mcmc(None, nsteps, progress=True)
-                else:
-                    sampler.run_mcmc(p0, nsteps, progress=True)
-                end = time.time()
-                multi_time = end - start
-                print("Multiprocessing took {0:.1f} seconds".format(multi_time))
+            kwargs_pool, blocks = {}, []
+            if shared:
+                model_shared, specs, blocks = self._get_shared_model()
+                kwargs_pool = dict(initializer=_init_shared_worker, initargs=(model_shared, specs))
+            try:
+                with (Pool(processes=nthreads, **kwargs_pool) if use_pool else contextlib.nullcontext()) as pool, executor:
+                    sampler = get_sampler(pool)
+                    multi_time = run_sampler(sampler)
+                    print("Multiprocessing took {0:.1f} seconds".format(multi_time))
+            finally:
+                for shm in blocks:
+                    shm.close()
+                    shm.unlink()
             
-        sampler_chain = sampler.chain
-        if use_zeus: sampler_chain = np.swapaxes(sampler.chain, 0, 1) #zeus chains shape (nsteps, nwalkers, npars) must be swapped
-        samples = sampler_chain[:, -nstats:] #3d matrix, chains shape (nwalkers, nstats, npars)
+        #Only the last nstats stored steps are read, from disk if chains are checkpointed. Chains shape (nsteps, nwalkers, npars)
+        nstored = sampler.iteration if not use_zeus else len(sampler.get_chain())
+        discard = nstored - nstats
+        samples = np.swapaxes(sampler.get_chain(discard=discard), 0, 1) #3d matrix, chains shape (nwalkers, nstats, npars)
         samples = samples.reshape(-1, samples.shape[-1]) #2d matrix, shape (nwalkers*nstats, npars). With -1 numpy guesses the x dimensionality
         best_params = np.median(samples, axis=0)
         self.mc_sampler = sampler
         self.mc_samples = samples
         self.best_params = best_params
 
-        samples_all = sampler_chain[:, :] #3d matrix, chains shape (nwalkers, nsteps, npars)
-        samples_all = samples_all.reshape(-1, samples.shape[-1]) #2d matrix, shape (nwalkers*nsteps, npars)
-        self.mc_samples_all = samples_all
+        if checkpoint is None:
+            samples_all = np.swapaxes(sampler.get_chain(), 0, 1) #3d matrix, chains shape (nwalkers, nsteps, npars)
+            samples_all = samples_all.reshape(-1, samples.shape[-1]) #2d matrix, shape (nwalkers*nsteps, npars)
+            self.mc_samples_all = samples_all
+        else: self.__dict__.pop('mc_samples_all', None) #whole chains remain on disk
         
-        #Errors: +- 68.2 percentiles
-        errpos, errneg = [], []
-        for i in range(self.mc_nparams):
-            tmp = best_params[i]
-            indpos = samples[:,i] > tmp
-            indneg = samples[:,i] < tmp
-            val = samples[:,i][indpos] - tmp
-            errpos.append(np.percentile(val, [68.2])) #1 sigma (2x perc 34.1), positive pars
-            val = np.abs(samples[:,i][indneg] - tmp)
-            errneg.append(np.percentile(val, [68.2])) 
-        self.best_params_errpos = np.asarray(errpos).squeeze()
-        self.best_params_errneg = np.asarray(errneg).squeeze()
+        #Errors: +- 68.2 percentiles of the deviations from the median on each side, 1 sigma (2x perc 34.1). All parameters at once
+        dev = samples - best_params
+        self.best_params_errpos = np.nanpercentile(np.where(dev > 0, dev, np.nan), 68.2, axis=0)
+        self.best_params_errneg = np.nanpercentile(np.where(dev < 0, -dev, np.nan), 68.2, axis=0)
         
         best_fit_dict = np.array([np.atleast_1d(arr) for arr in [p0_mean, best_params, self.best_params_errneg, self.best_params_errpos]]).T
         best_fit_dict = {key+'_'+self.mc_kind[i]: str(best_fit_dict[i].tolist())[1:-1] for i,key in enumerate(self.mc_header)}
+
+        if linear_amplitude: #Amplitude blobs, shape (nsteps, nwalkers)
+            amp_samples = np.asarray(sampler.get_blobs(discard=discard), dtype=np.float64).T.ravel()
+            if checkpoint is None: self.mc_amplitude_samples_all = np.asarray(sampler.get_blobs(), dtype=np.float64).T.ravel()
+            else: self.__dict__.pop('mc_amplitude_samples_all', None)
+            self.mc_amplitude_samples = amp_samples
+            self.best_amplitude = np.nanmedian(amp_samples)
+            amp_err = [np.nanpercentile(np.abs(amp_samples[ind] - self.best_amplitude), 68.2) if np.any(ind) else 0.0
+                       for ind in [amp_samples < self.best_amplitude, amp_samples > self.best_amplitude]]
+            self.best_amplitude_errneg, self.best_amplitude_errpos = amp_err
+            best_fit_dict['I0_intensity'] = str([np.nan, self.best_amplitude] + amp_err)[1:-1]
+            self.params['intensity']['I0'] = self.best_amplitude #models made after the fit have the best-fit amplitude
         self.best_fit_dict = best_fit_dict
         
         _break_line(init='\n')
-        print ('Median from parameter walkers for the last %d steps:\n'%nstats)        
+        print ('Median from parameter walkers for the last %d steps:\n'%(nstats*thin_by))        
         if found_termtables:
             tt_header = ['Parameter', 'Best-fit value', 'error [-]', 'error [+]']
             tt_data = np.array([np.atleast_1d(arr) for arr in [self.mc_header, self.best_params, self.best_params_errneg, self.best_params_errpos]]).T
@@ -1237,6 +2066,8 @@ class Model(Height, Velocity, Intensity, Linewidth, Lineslope, GridTools, Mcmc):
                 )
         else:
             print (list(zip(self.mc_header, best_params)))
+        if linear_amplitude:
+            print ('\nIntensity amplitude I0 (%s): %.4g -%.4g +%.4g'%(linear_amplitude, self.best_amplitude, self.best_amplitude_errneg, self.best_amplitude_errpos))
         _break_line(init='\n', end='\n\n')
 
         #************
@@ -1244,8 +2075,9 @@ class Model(Height, Velocity, Intensity, Linewidth, Lineslope, GridTools, Mcmc):
         #************
         #for key in custom_header: self.mc_header[key] = custom_header[key]
         #for key in custom_kind: self.mc_kind[key] = custom_kind[key]
-        if plot_walkers: 
-            Mcmc.plot_walkers(sampler_chain.T, best_params, header=self.mc_header, kind=self.mc_kind, nstats=nstats, tag=tag)
+        if plot_walkers: #steps in the plot are stored steps. Chains are thinned to at most ~1000 steps, only those are read from disk if checkpointed
+            thin = max(1, nstored//1000)
+            Mcmc.plot_walkers(sampler.get_chain(thin=thin).transpose(2, 0, 1), best_params, header=self.mc_header, kind=self.mc_kind, nstats=nstats, tag=tag, thin=thin)
         if plot_corner: 
             Mcmc.plot_corner(samples, labels=self.mc_header)
             plt.savefig('mc_corner_%s_%dwalkers_%dsteps.png'%(tag, nwalkers, nsteps))
@@ -1295,37 +2127,20 @@ class Model(Height, Velocity, Intensity, Linewidth, Lineslope, GridTools, Mcmc):
             print ('Using height and orientation parameters from prototype model:\n')
             pprint.pprint({key: self.params[key] for key in ['height_upper', 'height_lower', 'orientation']})
             
-        incl, PA, xc, yc = Model.orientation(**self.params['orientation'])
-        cos_incl, sin_incl = np.cos(incl), np.sin(incl)
-
-        #*******************************************
-        #MAKE TRUE GRID FOR UPPER AND LOWER SURFACES
-        z_true = {}
-        z_true['upper'] = self.z_upper_func({'R': self.R_true, 'phi': self.phi_true}, **self.params['height_upper'])
-
-        if z_mirror: z_true['lower'] = -z_true['upper']
-        else: z_true['lower'] = self.z_lower_func({'R': self.R_true, 'phi': self.phi_true}, **self.params['height_lower']) 
-
-        grid_true = {'upper': [self.x_true, self.y_true, z_true['upper'], self.R_true, self.phi_true], 
-                     'lower': [self.x_true, self.y_true, z_true['lower'], self.R_true, self.phi_true]}
+        grid_true, plans = self._make_grid_true(z_mirror=z_mirror)
         
         #***********************************
         #PROJECT PROPERTIES ON THE SKY PLANE        
         R, phi, z = {}, {}, {}
         for side in ['upper', 'lower']:
-            xt, yt, zt = grid_true[side][:3]
-            x_pro, y_pro, z_pro = self._project_on_skyplane(xt, yt, zt, cos_incl, sin_incl)
-            if PA: x_pro, y_pro = self._rotate_sky_plane(x_pro, y_pro, PA)             
-            x_pro = x_pro+xc
-            y_pro = y_pro+yc
-            R[side] = griddata((x_pro, y_pro), self.R_true, (self.mesh[0], self.mesh[1]), method='linear')
-            x_grid = griddata((x_pro, y_pro), xt, (self.mesh[0], self.mesh[1]), method='linear')
-            y_grid = griddata((x_pro, y_pro), yt, (self.mesh[0], self.mesh[1]), method='linear')
+            xt, yt, zt, Rt = grid_true[side][:4]
+            plan = plans[side]
+            R[side] = plan.apply(Rt)
+            x_grid = plan.apply(xt)
+            y_grid = plan.apply(yt)
             phi[side] = np.arctan2(y_grid, x_grid) #-np.pi, np.pi output for user 
-            z[side] = griddata((x_pro, y_pro), z_true[side], (self.mesh[0], self.mesh[1]), method='linear')
+            z[side] = plan.apply(zt)
             #r[side] = hypot_func(R[side], z[side])
-            if self.Rmax_m is not None: 
-                for prop in [R, phi, z]: prop[side] = np.where(np.logical_and(R[side]<self.Rmax_m, R[side]>self.Rmin_m), prop[side], np.nan)
 
             if writebinaries:
                 print ('Saving projected R,phi,z disc coordinates for %s emission surface into .npy binaries...'%side)
@@ -1349,6 +2164,112 @@ class Model(Height, Velocity, Intensity, Linewidth, Lineslope, GridTools, Mcmc):
 
         return R, phi, z, R_nonan, phi_nonan, z_nonan
 
+    def _get_plan_key(self, side, z_mirror=False):
+        if side=='upper' or z_mirror: z_func, z_kwargs = self.z_upper_func, self.params['height_upper']
+        else: z_func, z_kwargs = self.z_lower_func, self.params['height_lower']
+        return (self.projection, side, z_mirror and side=='lower', z_func, _freeze(z_kwargs), _freeze(self.params['orientation']), self.Rmin_m, self.Rmax_m)
+    
+    def get_reprojection_plan(self, side, z_true, z_mirror=False):
+        """
+        Get interpolation weights from the disc grid, projected on the sky for the current orientation and height parameters of the ``side`` emission surface, onto the sky grid.
+
+        Plans are cached, and reused as long as the orientation and height parameters of the surface remain unchanged. Sky pixels whose deprojected radius is beyond ``Rmax`` or within ``Rmin`` are flagged as invalid and set to NaN by the plan.
+
+        Parameters
+        ----------
+        side : str
+            'upper' or 'lower' emission surface.
+
+        z_true : array_like, shape (ncells,)
+            Height of the emission surface on the disc grid, as returned by ``z_upper_func`` or ``z_lower_func``. Ignored if self.projection='inverse'.
+
+        Returns
+        -------
+        plan : `~discminer.grid.ReprojectionPlan` or `~discminer.grid.LineOfSightPlan`
+        """
+        key = self._get_plan_key(side, z_mirror=z_mirror)
+        keep_tri = self.projection == 'interpolate' and side == 'upper' and z_mirror #triangulation reused by the mirrored lower plan
+        plan = self._plan_cache.get(key)
+        if plan is not None and (plan.tri is not None or not keep_tri): return plan
+
+        incl, PA, xc, yc = Model.orientation(**self.params['orientation'])
+        if self.projection == 'interpolate' and side == 'lower' and z_mirror and self._is_mirror_symmetric(z_true):
+            plan = self._get_mirror_plan(self.get_reprojection_plan('upper', -z_true, z_mirror=True).tri, PA, xc, yc)
+            R_grid = plan.apply(self.R_true)
+        elif self.projection == 'inverse':
+            z_func, z_kwargs = self._get_height_func(side, z_mirror=z_mirror)
+            x_pro, y_pro = self.mesh[0]-xc, self.mesh[1]-yc
+            if PA: x_pro, y_pro = self._rotate_sky_plane(x_pro.ravel(), y_pro.ravel(), -PA)
+            plan = LineOfSightPlan(np.reshape(x_pro, self.mesh[0].shape), np.reshape(y_pro, self.mesh[0].shape), z_func, z_kwargs, incl, dtype=self.dtype)
+            R_grid = plan.R
+        else:
+            x_pro, y_pro, z_pro = self._project_on_skyplane(self.x_true, self.y_true, z_true, np.cos(incl), np.sin(incl))
+            if PA: x_pro, y_pro = self._rotate_sky_plane(x_pro, y_pro, PA)
+            plan = ReprojectionPlan((x_pro+xc, y_pro+yc), (self.mesh[0], self.mesh[1]), dtype=self.dtype, keep_tri=keep_tri)
+            R_grid = plan.apply(self.R_true)
+        plan.restrict(np.logical_and(R_grid<self.Rmax_m, R_grid>self.Rmin_m))
+        return self._plan_cache.set(key, plan)
+
+    def _get_mirror_plan(self, tri, PA, xc, yc):
+        """
+        Lower-surface plan of a mirrored disc, z_lower = -z_upper, derived from the upper-surface triangulation tri (see get_reprojection_plan).
+
+        The lower surface at disc coordinates (x, y) projects on the sky at the reflection of the upper surface at (x, -y), 
+        about the projected disc major axis. The upper plan is therefore evaluated on reflected sky targets, 
+        and its columns are mapped to the mirrored disc grid cells.
+
+        This assumes an emission surface symmetric about the disc x axis, z(R, phi) = z(R, -phi), see _is_mirror_symmetric. 
+        Otherwise get_reprojection_plan triangulates the lower surface independently.
+        """
+        x_sky, y_sky = self.mesh[0]-xc, self.mesh[1]-yc
+        x_sky, y_sky = self._rotate_sky_plane(x_sky.ravel(), y_sky.ravel(), -PA)
+        x_sky, y_sky = self._rotate_sky_plane(x_sky, -y_sky, PA)
+        shape = self.mesh[0].shape
+        plan = ReprojectionPlan(tri.points.T, (np.reshape(x_sky+xc, shape), np.reshape(y_sky+yc, shape)), tri=tri, dtype=self.dtype)
+        plan.weights.indices = self._mirror_index[plan.weights.indices].astype(plan.weights.indices.dtype)
+        plan.weights.has_sorted_indices = False
+        return plan
+
+    def _is_mirror_symmetric(self, z_true):
+        #Whether the surface heights on the disc grid are symmetric under (x, y) -> (x, -y), i.e. phi -> -phi
+        return np.allclose(z_true, z_true[self._mirror_index], rtol=1e-10, atol=0, equal_nan=True)
+
+    @property
+    def _mirror_index(self):
+        #Index of the disc grid cell at (x, -y) for each cell at (x, y)
+        nx = self.grid['nx']
+        return np.arange(nx**2).reshape(nx, nx)[::-1].ravel()
+        
+    def _get_height_func(self, side, z_mirror=False):
+        if side=='upper': return self.z_upper_func, self.params['height_upper']
+        if not z_mirror: return self.z_lower_func, self.params['height_lower']
+        z_upper_func, z_upper_kwargs = self.z_upper_func, self.params['height_upper']
+        def z_lower_mirror(coord, **kwargs):
+            return -z_upper_func(coord, **kwargs)
+        return z_lower_mirror, z_upper_kwargs
+
+    def _make_grid_true(self, z_mirror=False):
+        """
+        Get coordinates where disc attributes are evaluated for each emission surface, and plans to project them on the sky grid.
+        These are disc grid coordinates if self.projection='interpolate', or the exact disc coordinates seen by each sky pixel if self.projection='inverse'.
+        """
+        grid_true = {}
+        if self.projection == 'inverse':
+            plans = self._map_sides(lambda side: self.get_reprojection_plan(side, None, z_mirror=z_mirror))
+            for side in ['upper', 'lower']:
+                plan = plans[side]
+                grid_true[side] = [plan.x, plan.y, plan.z, plan.R, plan.phi]
+        else:
+            z_true = {}
+            z_true['upper'] = self.z_upper_func({'R': self.R_true, 'phi': self.phi_true}, **self.params['height_upper'])
+            if z_mirror: z_true['lower'] = -z_true['upper']
+            else: z_true['lower'] = self.z_lower_func({'R': self.R_true, 'phi': self.phi_true}, **self.params['height_lower']) 
+            #The lower plan of a mirrored disc is derived from the upper plan, see get_reprojection_plan
+            plans = self._map_sides(lambda side: self.get_reprojection_plan(side, z_true[side], z_mirror=z_mirror), parallel=not z_mirror)
+            for side in ['upper', 'lower']:
+                grid_true[side] = [self.x_true, self.y_true, z_true[side], self.R_true, self.phi_true]
+        return grid_true, plans
+        
     def make_disc_axes(self, ax, Rmax=None, surface='upper'): 
         if Rmax is None:
             Rmax = self.Rmax.to('au')
@@ -1382,6 +2303,94 @@ class Model(Height, Velocity, Intensity, Linewidth, Lineslope, GridTools, Mcmc):
         )
         
             
+    def _make_props(self, ids, prop_funcs, prop_kwargs, cos_incl, sin_incl, z_mirror=False):
+        """
+        Compute the attributes listed in ids (0: velocity, 1: intensity, 2: linewidth, 3: lineslope) 
+        on the disc coordinates of each emission surface, and project them on the sky grid.
+        """
+        #*******************************************
+        #MAKE TRUE GRID FOR UPPER AND LOWER SURFACES
+        grid_true, plans = self._make_grid_true(z_mirror=z_mirror)
+        log_coords = {side: self._get_log_coords(side, grid_true[side][3], grid_true[side][2], z_mirror=z_mirror) for side in ['upper', 'lower']}
+
+        if (self.velocity_func is Velocity.keplerian_vertical_selfgravity or
+            self.velocity_func is Velocity.keplerian_vertical_selfgravity_pressure):
+            z_1d = self.z_upper_func({'R': self.R_1d*sfu.au}, **self.params['height_upper'])/sfu.au
+            if z_mirror: z_far_1d = -z_1d
+            else: z_far_1d = self.z_lower_func({'R': self.R_1d*sfu.au}, **self.params['height_lower'])/sfu.au
+        else: z_1d = z_far_1d = None
+
+        grid_true['upper'] += [self.R_1d, z_1d, log_coords['upper']]
+        grid_true['lower'] += [self.R_1d, z_far_1d, log_coords['lower']]
+
+        #**********************************
+        #COMPUTE PROPERTIES ON DISC COORDS 
+        if self._compute_prop is not _compute_prop_standard: compute_prop = self._compute_prop #user-defined
+        elif z_mirror: #Both sides share disc grid coordinates unless projection='inverse'
+            compute_prop = functools.partial(_compute_prop_mirror, shared_grid=self.projection=='interpolate')
+        elif self._get_model_executor() is not None: #one thread per surface
+            def compute_prop(grid, funcs, kwargs):
+                props_side = self._map_sides(lambda side: _compute_prop_standard(grid, funcs, kwargs, sides=[side]))
+                return [{side: props_side[side][i][side] for side in props_side} for i in range(len(funcs))]
+        else: compute_prop = self._compute_prop
+        has_vel = ids[0] == 0
+        
+        if self.subpixels and has_vel: #Velocities on all subpixels at once, other attributes on parent pixels
+            sub_coord = {'R': self.sub_R_true, 'phi': self.sub_phi_true}
+            z_sub = {'upper': self.z_upper_func(sub_coord, **self.params['height_upper'])}
+            if z_mirror: z_sub['lower'] = -z_sub['upper']
+            else: z_sub['lower'] = self.z_lower_func(sub_coord, **self.params['height_lower'])
+            vel_grid_true = {side: [self.sub_x_true, self.sub_y_true, z_sub[side], self.sub_R_true, self.sub_phi_true] + grid_true[side][5:7]
+                             for side in ['upper', 'lower']}
+            props = compute_prop(vel_grid_true, prop_funcs[:1], prop_kwargs[:1])
+            props += compute_prop(grid_true, prop_funcs[1:], prop_kwargs[1:])
+        else:
+            vel_grid_true = grid_true
+            props = compute_prop(grid_true, prop_funcs, prop_kwargs)
+
+        def project_side(side):
+            if has_vel: #Convention: positive vel (+) means gas receding from observer
+                vsys = prop_kwargs[0]['vsys']
+                phi_true = vel_grid_true[side][4]
+                phi_fac = sin_incl * np.cos(phi_true) #phi component
+                if len(props[0][side])==3: #3D vel
+                    v3d = props[0][side]
+                    r_fac = sin_incl * np.sin(phi_true)
+                    z_fac = cos_incl
+                    props[0][side] = v3d[0]*phi_fac - v3d[1]*r_fac - v3d[2]*z_fac
+                else: #1D vel, assuming vphi only
+                    props[0][side] *= phi_fac 
+                props[0][side] += vsys
+
+            #***********************************
+            #PROJECT PROPERTIES ON THE SKY PLANE        
+            plan = plans[side]
+            for i, prop in zip(ids, props):
+                if isinstance(prop[side], numbers.Number): prop[side] = np.where(plan.valid, prop[side], np.nan).reshape(plan.shape)
+                elif i==0 and self.subpixels: #Subpixels share the plan of their parent pixels, shape (subpixels**2, ny, nx)
+                    prop[side] = np.moveaxis(plan.apply(prop[side].T), -1, 0)
+                else: prop[side] = plan.apply(prop[side])
+
+        #Mirrored attributes may share arrays between sides (see _compute_prop_mirror), sides are then processed serially
+        self._map_sides(project_side, parallel=not z_mirror)
+        return props
+
+    def _get_log_coords(self, side, R, z, z_mirror=False):
+        #log(R) and log|z| on the coordinates of an emission surface, reused while its geometry is unchanged. See _powerlaw_Rz
+        key = self._get_plan_key(side, z_mirror=z_mirror)
+        log_coords = self._log_coords_cache.get(key)
+        if log_coords is None:
+            with np.errstate(divide='ignore'):
+                log_coords = {'logR': np.log(R), 'logz': np.log(np.abs(z))}
+            log_coords = self._log_coords_cache.set(key, log_coords)
+        return log_coords
+
+    def _get_stage_key(self, i, func, kwargs, z_mirror=False):
+        #Projected attribute i depends on its own function and parameters, and on the geometry of both emission surfaces.
+        # Self-gravity terms also depend on the radial grid R_1d, and on the heights z_1d computed on it from the geometry parameters
+        geometry = (self._get_plan_key('upper', z_mirror=z_mirror), self._get_plan_key('lower', z_mirror=z_mirror))
+        return (i, func, _freeze(kwargs), geometry, z_mirror, self.subpixels, self._compute_prop, _freeze(self.R_1d))
+    
     def make_model(self, z_mirror=False, **kwargs_get_cube):                   
         if self.prototype: 
             _break_line()
@@ -1397,93 +2406,24 @@ class Model(Height, Velocity, Intensity, Linewidth, Lineslope, GridTools, Mcmc):
 
         cos_incl, sin_incl = np.cos(incl), np.sin(incl)
 
-        #*******************************************
-        #MAKE TRUE GRID FOR UPPER AND LOWER SURFACES
-        z_true = self.z_upper_func({'R': self.R_true, 'phi': self.phi_true}, **self.params['height_upper'])
-
-        if z_mirror: z_true_far = -z_true
-        else: z_true_far = self.z_lower_func({'R': self.R_true, 'phi': self.phi_true}, **self.params['height_lower']) 
-
-        if (self.velocity_func is Velocity.keplerian_vertical_selfgravity or
-            self.velocity_func is Velocity.keplerian_vertical_selfgravity_pressure):
-            z_1d = self.z_upper_func({'R': self.R_1d*sfu.au}, **self.params['height_upper'])/sfu.au
-            if z_mirror: z_far_1d = -z_1d
-            else: z_far_1d = self.z_lower_func({'R': self.R_1d*sfu.au}, **self.params['height_lower'])/sfu.au
-        else: z_1d = z_far_1d = None
-
-        grid_true = {'upper': [self.x_true, self.y_true, z_true, self.R_true, self.phi_true, self.R_1d, z_1d], 
-                     'lower': [self.x_true, self.y_true, z_true_far, self.R_true, self.phi_true, self.R_1d, z_far_1d]}
-
-        #******************************
-        #COMPUTE PROPERTIES ON SKY GRID 
+        #*****************************************
+        #REUSE ATTRIBUTES WITH UNCHANGED PARAMETERS
         avai_kwargs = [vel_kwargs, int_kwargs, lw_kwargs, ls_kwargs]
         avai_funcs = [self.velocity_func, self.intensity_func, self.linewidth_func, self.lineslope_func]
         true_kwargs = [isinstance(kwarg, dict) for kwarg in avai_kwargs]
-        prop_kwargs = [kwarg for i, kwarg in enumerate(avai_kwargs) if true_kwargs[i]]
-        prop_funcs = [func for i, func in enumerate(avai_funcs) if true_kwargs[i]]
-       
-        if self.subpixels:
-            subpix_vel = []
-            for i in range(self.subpixels):
-                for j in range(self.subpixels):
-                    z_true = self.z_upper_func({'R': self.sub_R_true[i][j]}, **self.params['height_upper'])
-                    
-                    if z_mirror: z_true_far = -z_true
-                    else: z_true_far = self.z_lower_func({'R': self.sub_R_true[i][j]}, **self.params['height_lower']) 
-
-                    subpix_grid_true = {'upper': [self.sub_x_true[j], self.sub_y_true[i], z_true, self.sub_R_true[i][j], self.sub_phi_true[i][j]], 
-                                        'lower': [self.sub_x_true[j], self.sub_y_true[i], z_true_far, self.sub_R_true[i][j], self.sub_phi_true[i][j]]}
-                    subpix_vel.append(self._compute_prop(subpix_grid_true, [self.velocity_func], [vel_kwargs])[0])
-
-            ang_fac = sin_incl * np.cos(self.phi_true) 
-            for i in range(self.subpixels_sq):
-                for side in ['upper', 'lower']:
-                    subpix_vel[i][side] *= ang_fac
-                    subpix_vel[i][side] += vel_kwargs['vsys']
-                    
-            props = self._compute_prop(grid_true, prop_funcs[1:], prop_kwargs[1:])
-            props.insert(0, subpix_vel)
-            
-        else: 
-            props = self._compute_prop(grid_true, prop_funcs, prop_kwargs)
-            if true_kwargs[0]: #Convention: positive vel (+) means gas receding from observer
-                phi_fac = sin_incl * np.cos(self.phi_true) #phi component
-                for side in ['upper', 'lower']:
-                    if len(props[0][side])==3: #3D vel
-                        v3d = props[0][side]
-                        r_fac = sin_incl * np.sin(self.phi_true)
-                        z_fac = cos_incl
-                        props[0][side] = v3d[0]*phi_fac - v3d[1]*r_fac - v3d[2]*z_fac
-                    else: #1D vel, assuming vphi only
-                        props[0][side] *= phi_fac 
-                    props[0][side] += vel_kwargs['vsys']
-
-        #***********************************
-        #PROJECT PROPERTIES ON THE SKY PLANE        
-        x_pro_dict = {}
-        y_pro_dict = {}
-        z_pro_dict = {}
-        for side in ['upper', 'lower']:
-            xt, yt, zt = grid_true[side][:3]
-            x_pro, y_pro, z_pro = self._project_on_skyplane(xt, yt, zt, cos_incl, sin_incl)
-            if PA: x_pro, y_pro = self._rotate_sky_plane(x_pro, y_pro, PA)             
-            x_pro = x_pro+xc
-            y_pro = y_pro+yc
-            if self.Rmax_m is not None: R_grid = griddata((x_pro, y_pro), self.R_true, (self.mesh[0], self.mesh[1]), method='linear')
-            x_pro_dict[side] = x_pro
-            y_pro_dict[side] = y_pro
-            z_pro_dict[side] = z_pro
-
-            if self.subpixels:
-                for i in range(self.subpixels_sq): #Subpixels are projected on the same plane where true grid is projected
-                    props[0][i][side] = griddata((x_pro, y_pro), props[0][i][side], (self.mesh[0], self.mesh[1]), method='linear') #subpixels velocity
-                for prop in props[1:]:
-                    prop[side] = griddata((x_pro, y_pro), prop[side], (self.mesh[0], self.mesh[1]), method='linear')
-                    if self.Rmax_m is not None: prop[side] = np.where(np.logical_and(R_grid<self.Rmax_m, R_grid>self.Rmin_m), prop[side], np.nan) #Todo: allow for R_in as well
-            else:
-                for prop in props:
-                    if not isinstance(prop[side], numbers.Number): prop[side] = griddata((x_pro, y_pro), prop[side], (self.mesh[0], self.mesh[1]), method='linear')
-                    if self.Rmax_m is not None: prop[side] = np.where(np.logical_and(R_grid<self.Rmax_m, R_grid>self.Rmin_m), prop[side], np.nan)
+        stage_keys = [self._get_stage_key(i, avai_funcs[i], avai_kwargs[i], z_mirror=z_mirror) if true_kwargs[i] else None for i in range(4)]
+        props_sky = {i: self._stage_cache.get(stage_keys[i]) for i in range(4) if true_kwargs[i]}
+        missing = [i for i in props_sky if props_sky[i] is None]
+
+        if missing:
+            props = self._make_props(missing, [avai_funcs[i] for i in missing], [avai_kwargs[i] for i in missing], 
+                                     cos_incl, sin_incl, z_mirror=z_mirror)
+            for i, prop in zip(missing, props):
+                for side in prop: 
+                    if isinstance(prop[side], np.ndarray): prop[side].flags.writeable = False #shared with the cache
+                props_sky[i] = self._stage_cache.set(stage_keys[i], prop)
+
+        props = [dict(props_sky[i]) for i in range(4) if true_kwargs[i]] #new dicts, cached arrays are read-only
             
         #*************************************
         if self.prototype:
@@ -1494,6 +2434,72 @@ class Model(Height, Velocity, Intensity, Linewidth, Lineslope, GridTools, Mcmc):
         else:
             return props
 
+    def make_keplerian_mask(self, vchannels=None, nlinewidths=3.0, beam_dilation=1.0, pad_channels=1, z_mirror=False, **kwargs_line):
+        """
+        Make a mask of the voxels where the model has emission, from the velocity and line width maps of the current model parameters (e.g. prototype or best-fit parameters). 
+
+        In each pixel, channels within nlinewidths line widths of the line-of-sight velocity of either emission surface are unmasked. 
+        The velocity bounds are then dilated spatially by the beam, and the channel range is padded on each side. 
+
+        Parameters
+        ----------
+        vchannels : array_like, optional
+            Velocity channels of the mask. Defaults to the channels of the model datacube.
+
+        nlinewidths : float, optional
+            Half-width of the unmasked velocity range in units of the line width. Defaults to 3.0. 
+            For bell line profiles, the half-width where the kernel drops to the Gaussian kernel value at nlinewidths is used instead (see _get_profile_halfwidth).
+
+        beam_dilation : float, optional
+            Radius of the spatial dilation in units of the beam FWHM. If 0 or the datacube has no beam, no dilation is applied. Defaults to 1.0.
+
+        pad_channels : int, optional
+            Number of channels added at each side of the unmasked range of each pixel. Defaults to 1.
+
+        Returns
+        -------
+        mask : `~discminer.tools.utils.KeplerianMask`
+            Mask to be passed to `~discminer.disc2d.Model.run_mcmc` or `~discminer.cube.Cube.make_moments`.
+        """
+        from scipy.ndimage import maximum_filter, minimum_filter
+        if vchannels is None: vchannels = self.vchannels
+        prototype = self.prototype
+        self.prototype = False #make_model returns attributes only
+        try: vel2d, int2d, linew2d, lineb2d = self.make_model(z_mirror=z_mirror)
+        finally: self.prototype = prototype
+
+        vlo, vhi = [], []
+        for side in ['upper', 'lower']:
+            vel = np.asarray(vel2d[side], dtype=np.float64)
+            half = self._get_profile_halfwidth(np.asarray(linew2d[side], dtype=np.float64), b_slope=lineb2d[side], cutoff=nlinewidths, **kwargs_line)
+            lo, hi = Model._get_velocity_bounds(vel, half, vchannels)
+            vlo.append(lo)
+            vhi.append(hi)
+        vlo, vhi = np.minimum(*vlo), np.maximum(*vhi)
+        
+        if beam_dilation and self.beam_kernel is not None:
+            #Kernel pixels within beam_dilation FWHMs of the centre, where the Gaussian is above 2**(-4*beam_dilation**2) of its peak
+            kernel = np.asarray(getattr(self.beam_kernel, 'array', self.beam_kernel))
+            footprint = kernel >= kernel.max()*2**(-4*beam_dilation**2)
+            vlo = minimum_filter(vlo, footprint=footprint, mode='constant', cval=np.inf)
+            vhi = maximum_filter(vhi, footprint=footprint, mode='constant', cval=-np.inf)
+            
+        mask = KeplerianMask.from_velocities(vlo, vhi, vchannels)
+        return mask.pad(pad_channels) if pad_channels else mask
+
+    @staticmethod
+    def _get_velocity_bounds(vel, half, vchannels):
+        """
+        Velocity range [vel-half, vel+half] of each pixel, see make_keplerian_mask. Bounds are clipped to the span of vchannels, 
+        so that very large or infinite half-widths (e.g. bell profiles with small line slopes, see _get_profile_halfwidth) unmask all channels.
+        Pixels where vel or half are NaN, i.e. outside the disc, get lo=inf and hi=-inf. Subpixel bounds, shape (nsub, ny, nx), are merged.
+        """
+        vmin, vmax = np.min(vchannels), np.max(vchannels)
+        with np.errstate(invalid='ignore'): 
+            lo, hi = np.maximum(vel - half, vmin), np.minimum(vel + half, vmax) #maximum and minimum propagate NaNs
+        if lo.ndim == 3: lo, hi = np.nanmin(lo, axis=0), np.nanmax(hi, axis=0) #subpixels
+        return np.where(np.isnan(lo), np.inf, lo), np.where(np.isnan(hi), -np.inf, hi)
+
 General2d = Model #Backcompat
 
 class _Rosenfeld2d(Velocity, Intensity, Linewidth, GridTools): #Deprecated
@@ -1,12 +1,14 @@
-from .tools.utils import FrontendUtils
+from .tools.utils import FrontendUtils, hypot_func
 from astropy import units as u
 from scipy.optimize import root
+from scipy.sparse import csr_matrix
+from scipy.spatial import Delaunay
 import numpy as np
 
 _break_line = FrontendUtils._break_line
 au_to_m = u.au.to('m')
 
-def grid(xmax, nx, indexing="xy", verbose=True):
+def grid(xmax, nx, indexing="xy", verbose=True, dtype=np.float64):
     """
     Compute Cartesian (x,y) and polar (R, phi) grid. Assuming square grid, namely ymax=xmax, and ny=nx.
     
@@ -21,6 +23,8 @@ def grid(xmax, nx, indexing="xy", verbose=True):
         Cartesian (‘xy’, default) or matrix (‘ij’) indexing of output xy meshgrid. See `~numpy.meshgrid`.
     verbose : bool, optional
         if True, print informative messages.
+    dtype : data-type, optional
+        Floating-point precision of output coordinate arrays. Defaults to np.float64.
 
     Returns
     -------    
@@ -42,11 +46,11 @@ def grid(xmax, nx, indexing="xy", verbose=True):
         print("Grid maximum extent:", xmax)
         print("Grid step (cell size):", step)
 
-    xgrid = np.linspace(-xmax, xmax, nx)
+    xgrid = np.linspace(-xmax, xmax, nx).astype(dtype)
     xygrid = [xgrid, xgrid]
     XY = np.meshgrid(xgrid, xgrid, indexing=indexing)
     xList, yList = [xy.flatten() for xy in XY]
-    RList = np.linalg.norm([xList, yList], axis=0)
+    RList = np.linalg.norm([xList, yList], axis=0).astype(dtype)
     phiList = np.arctan2(yList, xList)
     #phiList = np.where(phiList < 0, phiList + 2 * np.pi, phiList)
     _break_line()
@@ -65,6 +69,123 @@ def grid(xmax, nx, indexing="xy", verbose=True):
         "extent": np.array([-xmax, xmax, -xmax, xmax])*u.m.to(u.au)
     }
 
+class ReprojectionPlan(object):
+    """
+    Piecewise-linear interpolation weights from scattered points (e.g. a disc grid projected on the sky)
+    onto a fixed set of target points (e.g. the sky grid). The Delaunay triangulation and barycentric 
+    weights are computed only once and stored as a sparse matrix, so that interpolating any property
+    sampled on the source points reduces to a sparse matrix-vector product. 
+    Results are equivalent to those of `~scipy.interpolate.griddata` with method='linear'.
+
+    Parameters
+    ----------
+    points : tuple of array_like, shape (npoints,) each
+        (x, y) coordinates of the source points.
+
+    xi : tuple of array_like
+        (x, y) coordinates of the target points. Any shape, the output of `apply` is given with this same shape.
+
+    tri : `~scipy.spatial.Delaunay`, optional
+        Precomputed triangulation of the input points.
+
+    dtype : data-type, optional
+        Floating-point precision of the interpolation weights. Defaults to np.float64.
+
+    keep_tri : bool, optional
+        If True, the triangulation is kept as the attribute ``tri`` (e.g. to build further plans from the same points). 
+        Otherwise ``tri`` is None, as the triangulation is typically several times larger than the weights. Defaults to False.
+    """
+    def __init__(self, points, xi, tri=None, dtype=np.float64, keep_tri=False):
+        points = np.column_stack([np.ravel(p) for p in points]).astype(np.float64)
+        self.shape = np.shape(xi[0])
+        xi = np.column_stack([np.ravel(p) for p in xi]).astype(np.float64)
+        if tri is None: tri = Delaunay(points)
+        self.tri = tri if keep_tri else None
+        self.npoints = len(points)
+        
+        simplex = tri.find_simplex(xi)
+        inside = simplex >= 0
+        ind = inside.nonzero()[0]
+        T = tri.transform[simplex[ind]]
+        bary = np.einsum('ijk,ik->ij', T[:, :2], xi[ind] - T[:, 2])
+        weights = np.column_stack([bary, 1 - bary.sum(axis=1)])
+        vertices = tri.simplices[simplex[ind]]
+
+        self.weights = csr_matrix((weights.ravel(), (np.repeat(ind, 3), vertices.ravel())),
+                                  shape=(len(xi), self.npoints), dtype=dtype)
+        self.inside = inside
+        self.valid = inside #target points where interpolated values are kept, see restrict()
+
+    def restrict(self, mask):
+        """Flag target points where ``mask`` is False as invalid. These are set to NaN by `apply`."""
+        self.valid = self.valid & np.ravel(mask)
+
+    def apply(self, values):
+        """
+        Interpolate values sampled on the source points onto the target points.
+
+        Parameters
+        ----------
+        values : array_like, shape (npoints,) or (npoints, k)
+            Properties sampled on the source points. If 2D, columns are interpolated simultaneously.
+
+        Returns
+        -------
+        interp : array_like, shape (*xi.shape) or (*xi.shape, k)
+        """
+        values = np.asarray(values)
+        interp = self.weights.dot(values)
+        interp[~self.valid] = np.nan
+        return interp.reshape(self.shape + values.shape[1:])
+
+
+
+class LineOfSightPlan(object):
+    """
+    Exact disc coordinates of the points where the lines of sight through a set of sky pixels intersect an emission surface. 
+    It exposes the same ``apply``/``restrict`` interface as `ReprojectionPlan`, but properties must be sampled on the 
+    intersection coordinates stored in this object (``x``, ``y``, ``z``, ``R``, ``phi``) instead of on the disc grid.
+
+    Parameters
+    ----------
+    x_pro, y_pro : array_like
+        Sky coordinates of the pixels, referred to the (unrotated, centred) disc frame. See `GridTools._project_on_skyplane`.
+
+    z_func : function
+        Emission surface height, z_func(coord, **z_kwargs) with coord = {'R': R, 'phi': phi}.
+    
+    z_kwargs : dict
+        Emission surface parameters.
+
+    incl : float
+        Disc inclination in radians.
+    
+    dtype : data-type, optional
+        Floating-point precision of the output coordinates. The solution is always computed in double precision.
+
+    kwargs : keyword arguments
+        Additional keyword arguments to pass to `GridTools._solve_line_of_sight`.
+    """
+    def __init__(self, x_pro, y_pro, z_func, z_kwargs, incl, dtype=np.float64, **kwargs):
+        self.shape = np.shape(x_pro)
+        x_pro = np.ravel(x_pro)
+        y_pro = np.ravel(y_pro)
+        y, z, converged = GridTools._solve_line_of_sight(x_pro, y_pro, z_func, z_kwargs, np.cos(incl), np.sin(incl), **kwargs)
+        self.x = x_pro.astype(dtype)
+        self.y = y.astype(dtype)
+        self.z = z.astype(dtype)
+        self.R = hypot_func(self.x, self.y)
+        self.phi = np.arctan2(self.y, self.x)
+        self.valid = converged
+
+    def restrict(self, mask):
+        self.valid = self.valid & np.ravel(mask)
+
+    def apply(self, values):
+        interp = np.where(self.valid, values, np.nan)
+        return interp.reshape(self.shape)
+
+    
 class GridTools:
     @staticmethod
     def _rotate_sky_plane(x, y, ang):
@@ -102,6 +223,48 @@ class GridTools:
         z_pro = y * sin_incl + z * cos_incl
         return x_pro, y_pro, z_pro
 
+    @staticmethod
+    def _solve_line_of_sight(x_pro, y_pro, z_func, z_kwargs, cos_incl, sin_incl, niter=30, rtol=1e-10):
+        """
+        Vectorised Newton iterations to find the disc coordinate y where the lines of sight through (x_pro, y_pro) 
+        on the sky plane intersect the emission surface z_func, i.e. the roots of y*cos_incl - z(x_pro, y)*sin_incl - y_pro = 0.
+        Initial guesses are the intersections with the disc midplane. Derivatives are computed by finite differences. 
+
+        Returns
+        -------
+        y, z : array_like
+            Disc y coordinate and height of the intersection points.
+        
+        converged : array_like
+            Boolean mask of points where the solution converged.
+        """
+        x = np.asarray(x_pro, dtype=np.float64)
+        y_pro = np.asarray(y_pro, dtype=np.float64)
+        y = y_pro/cos_incl
+        converged = np.zeros(y.shape, dtype=bool)
+        scale = np.max(np.abs(np.append(x, y))) + 1.0
+        
+        def height(x, y):
+            coord = {'R': hypot_func(x, y), 'phi': np.arctan2(y, x)}
+            return np.broadcast_to(z_func(coord, **z_kwargs), x.shape)
+        
+        ind = np.arange(y.size)
+        for _ in range(niter):
+            xi, yi = x[ind], y[ind]
+            h = 1e-7*scale
+            f0 = yi*cos_incl - height(xi, yi)*sin_incl - y_pro[ind]
+            f1 = (yi+h)*cos_incl - height(xi, yi+h)*sin_incl - y_pro[ind]
+            dy = f0*h/(f1-f0)
+            y[ind] = yi - dy
+            done = np.abs(dy) <= rtol*scale
+            converged[ind[done]] = True
+            ind = ind[~done & np.isfinite(dy)]
+            if not ind.size: break
+            
+        z = height(x, y)
+        converged &= np.isfinite(z)
+        return y, z, converged
+
     @staticmethod
     def get_sky_from_disc_coords(R, az, z, incl, PA, xc=0, yc=0):
         xp = R*np.cos(az)
@@ -36,6 +36,14 @@ def _doublebell_mask(x, *p):
     bell2 = A2/(1+np.abs((x-mu2)/sigma2)**(2*Ls2))
     return np.where(bell1>=bell2, bell1, bell2)
 
+def _get_peak(data, keplerian_mask=None):
+    #Channel index and intensity of the line peak in each pixel, only over the unmasked channels of keplerian_mask if given
+    if keplerian_mask is None:
+        return np.nanargmax(data, axis=0), np.nanmax(data, axis=0)
+    masked = np.where(keplerian_mask.cube, np.nan_to_num(data, nan=-np.inf), -np.inf)
+    ind_max = np.argmax(masked, axis=0)
+    return ind_max, np.take_along_axis(masked, ind_max[None], axis=0)[0]
+
 def _not_available(method):
     raise InputError(method, "requested moment method is currently unavailable")
 
@@ -99,8 +107,15 @@ def get_channels_from_parcube(parcube_up, parcube_low, vchannels, method='double
 def fit_twocomponent(cube, model=None, lw_chans=1.0, lower2upper=1.0,
                      method='doublegaussian', kind='mask', sigma_thres=5,
                      sigma_fit=None,
-                     niter=4, neighs=5, av_func=np.nanmedian
+                     niter=4, neighs=5, av_func=np.nanmedian,
+                     keplerian_mask=None
 ):
+    """
+    Fit two-component 'doublegaussian' or 'doublebell' profiles along the velocity axis of the input cube.
+
+    If keplerian_mask (see `~discminer.disc2d.Model.make_keplerian_mask`) is given, line profiles are fitted on the unmasked channels of each pixel only, 
+    and pixels without enough unmasked channels are skipped. 
+    """
 
     data = cube.data    
     vchannels = cube.vchannels
@@ -125,8 +140,7 @@ def fit_twocomponent(cube, model=None, lw_chans=1.0, lower2upper=1.0,
     #MODEL AS INITIAL GUESS?
     if model is None:
         print ('Guessing upper surface properties from data to use them as seeds for both upper (primary) and lower (secondary) surface components ...')        
-        ind_max = np.nanargmax(data, axis=0)
-        I_max = np.nanmax(data, axis=0)
+        ind_max, I_max = _get_peak(data, keplerian_mask)
         vel_peak = vchannels[ind_max]
         I_max_upper = I_max
         I_max_lower = lower2upper*I_max
@@ -152,8 +166,7 @@ def fit_twocomponent(cube, model=None, lw_chans=1.0, lower2upper=1.0,
             I_lower = get_tb(1e3*I_lower*cube.beam_area, restfreq, cube.beam, full=False) 
 
         #Initial guesses
-        ind_max = np.nanargmax(data, axis=0)
-        cube_max = np.take_along_axis(data, ind_max[None], axis=0).squeeze()
+        ind_max, cube_max = _get_peak(data, keplerian_mask)
         I_max_upper = np.where(np.isnan(I_upper), 1.0*cube_max, I_upper)
         I_max_lower = np.where(np.isnan(I_lower), 0.5*cube_max, I_lower)
         vel_peak_upper = np.where(np.isnan(vel2d['upper']), vchannels[ind_max], vel2d['upper'])
@@ -163,8 +176,11 @@ def fit_twocomponent(cube, model=None, lw_chans=1.0, lower2upper=1.0,
         ls_upper = np.where(np.isnan(linew2d['upper']), 1.5, lineb2d['upper'])
         ls_lower = np.where(np.isnan(linew2d['lower']), 1.5, lineb2d['lower'])
 
+    if keplerian_mask is None: chan_func = lambda i,j: slice(None)
+    else: chan_func = keplerian_mask.channels
+
     if sigma_fit is None: sigma_func = lambda i,j: None
-    else: sigma_func = lambda i,j: sigma_fit[:,i,j]
+    else: sigma_func = lambda i,j: sigma_fit[chan_func(i,j),i,j]
 
     noise = np.std( np.append(data[:5,:,:], data[-5:,:,:], axis=0), axis=0) #rms intensity from first and last 5 channels
     mask = np.nanmax(data, axis=0) <= sigma_thres*noise
@@ -205,6 +221,9 @@ def fit_twocomponent(cube, model=None, lw_chans=1.0, lower2upper=1.0,
     else:
         _not_available(method)
 
+    if keplerian_mask is not None: #skip pixels with fewer unmasked channels than free parameters
+        mask = mask | (keplerian_mask.hi - keplerian_mask.lo < 2*idlow[0])
+        
     def fill_props(i, j, coeff):
         peak_up[i,j] = coeff[0]
         centroid_up[i,j] = coeff[1]
@@ -234,16 +253,17 @@ def fit_twocomponent(cube, model=None, lw_chans=1.0, lower2upper=1.0,
     #MAKE FIT
     for i in range(nx):
         for j in range(ny):
-            tmp_data = data[:,i,j]
-
             if mask[i,j]:
                 n_mask += 1
                 n_fit[i,j] = -10                                    
                 continue
+
+            chans = chan_func(i,j)
+            tmp_data, tmp_vchannels = data[chans,i,j], vchannels[chans]
             
             try: 
                 coeff, var_matrix = curve_fit(fit_func,
-                                              vchannels, tmp_data,
+                                              tmp_vchannels, tmp_data,
                                               p0=pfunc_two(i,j),
                                               ftol=1e-10, xtol=1e-10, gtol=1e-10, method='lm')
                                               #bounds = [bound0, bound1])
@@ -254,7 +274,7 @@ def fit_twocomponent(cube, model=None, lw_chans=1.0, lower2upper=1.0,
             except RuntimeError:
                 try: 
                     coeff, var_matrix = curve_fit(fit_func1d,
-                                                  vchannels, tmp_data,
+                                                  tmp_vchannels, tmp_data,
                                                   p0=pfunc_one(i,j)
                     )
                     coeff = np.append(coeff, coeff)
@@ -374,11 +394,12 @@ def fit_twocomponent(cube, model=None, lw_chans=1.0, lower2upper=1.0,
                 if uplow is None:
                     continue
 
-                tmp_data = data[:,i,j]
+                chans = chan_func(i,j)
+                tmp_data, tmp_vchannels = data[chans,i,j], vchannels[chans]
 
                 try:                    
                     coeff, var_matrix = curve_fit(fit_func,
-                                                  vchannels, tmp_data,
+                                                  tmp_vchannels, tmp_data,
                                                   p0 = uplow,
                                                   ftol=1e-10, xtol=1e-10, gtol=1e-10, method='lm')
                     deltas = np.sqrt(np.abs(np.diag(var_matrix)))
@@ -388,7 +409,7 @@ def fit_twocomponent(cube, model=None, lw_chans=1.0, lower2upper=1.0,
                 except RuntimeError:
                     try: 
                         coeff, var_matrix = curve_fit(fit_func1d,
-                                                      vchannels, tmp_data,
+                                                      tmp_vchannels, tmp_data,
                                                       p0=pfunc_one(i,j)
                         )
                         coeff = np.append(coeff, coeff)
@@ -414,7 +435,7 @@ def fit_gaussian(*args, **kwargs): #Backcompat
     return fit_onecomponent(*args, **kwargs)
 
 def fit_onecomponent(
-        cube, method='gaussian', lw_chans=1.0, peak_kernel=True, sigma_fit=None, sigma_thres=4
+        cube, method='gaussian', lw_chans=1.0, peak_kernel=True, sigma_fit=None, sigma_thres=4, keplerian_mask=None
 ):
     """
     Fit 'gaussian' or 'bell' profiles along the velocity axis of the input cube.
@@ -430,6 +451,9 @@ def fit_onecomponent(
     peak_kernel : bool, optional
         If True (default) the returned amplitude is the peak of the kernel fitted to the line. Otherwise, the actual peak of the line profile is returned.
 
+    keplerian_mask : `~discminer.tools.utils.KeplerianMask`, optional
+        If given, line profiles are fitted on the unmasked channels of each pixel only, and pixels without enough unmasked channels are skipped. See `~discminer.disc2d.Model.make_keplerian_mask`.
+
     Returns
     -------
     A,B,C,dA,dB,dC : 2-D arrays
@@ -450,14 +474,16 @@ def fit_onecomponent(
 
     is_bell = method=='bell'
     
-    ind_max = np.nanargmax(data, axis=0)
-    I_max = np.nanmax(data, axis=0)
+    ind_max, I_max = _get_peak(data, keplerian_mask)
     vel_peak = vchannels[ind_max]
     dv = lw_chans*np.mean(vchannels[1:]-vchannels[:-1])
     Ls = 2.0 #p0 Line slope
     
+    if keplerian_mask is None: chan_func = lambda i,j: slice(None)
+    else: chan_func = keplerian_mask.channels
+
     if sigma_fit is None: sigma_func = lambda i,j: None
-    else: sigma_func = lambda i,j: sigma_fit[:,i,j]
+    else: sigma_func = lambda i,j: sigma_fit[chan_func(i,j),i,j]
 
     #******************************
     #KERNELS AND RELEVANT FUNCTIONS
@@ -477,20 +503,23 @@ def fit_onecomponent(
 
     noise = np.std( np.append(data[:5,:,:], data[-5:,:,:], axis=0), axis=0) #rms intensity from first and last 5 channels
     mask = np.nanmax(data, axis=0) <= sigma_thres*noise
+    if keplerian_mask is not None: #skip pixels with fewer unmasked channels than free parameters
+        mask = mask | (keplerian_mask.hi - keplerian_mask.lo < len(pfunc_one(0,0)))
         
     print ('Fitting one-component function along velocity axis of the input cube...')
 
     for i in range(nx):
         for j in range(ny):
-            tmp_data = data[:,i,j]
-            
             if mask[i,j]:
                 n_mask += 1
                 n_fit[i,j] = -10                                    
                 continue
+
+            chans = chan_func(i,j)
+            tmp_data, tmp_vchannels = data[chans,i,j], vchannels[chans]
             
             try:
-                coeff, var_matrix = curve_fit(fit_func1d, vchannels, tmp_data, p0=pfunc_one(i,j), sigma=sigma_func(i,j))
+                coeff, var_matrix = curve_fit(fit_func1d, tmp_vchannels, tmp_data, p0=pfunc_one(i,j), sigma=sigma_func(i,j))
                 n_fit[i,j] = 1
                     
             except RuntimeError: 
@@ -1,5 +1,7 @@
 import os
 import sys
+import threading
+from collections import OrderedDict
 import numpy as np
 from astropy import units as u
 from astropy import constants as apc
@@ -8,6 +10,31 @@ from .. import units as sfu
 
 hypot_func = lambda x,y: np.sqrt(x**2 + y**2) #Slightly faster than np.hypot<np.linalg.norm<scipydistance. Checked precision up to au**2 orders.
 
+def _powerlaw_Rz(coord, A, R0, p, z0, q):
+    """
+    A*(R/R0)**p*(|z|/z0)**q. 
+    If coord provides cached logarithms of the coordinates, 'logR' and 'logz' (i.e. log|z|), it is evaluated as a single exp in log space, and terms with zero exponents are skipped.
+    p can be an array broadcastable to R, e.g. for broken power laws.
+    """
+    if 'logR' not in coord:
+        if 'R' not in coord.keys(): R = hypot_func(coord['x'], coord['y'])
+        else: R = coord['R']
+        return A*(R/R0)**p*(np.abs(coord['z'])/z0)**q
+    expo, c = None, 0.0
+    if np.ndim(p) or p != 0:
+        expo = p*coord['logR']
+        c = c - p*np.log(R0)
+    if q != 0:
+        if expo is None: expo = q*coord['logz']
+        else: expo += q*coord['logz']
+        c = c - q*np.log(z0)
+    if expo is None: return np.full_like(coord['logR'], A)
+    if A > 0:
+        expo += c + np.log(A)
+        return np.exp(expo, out=expo)
+    expo += c
+    return A*np.exp(expo)
+
 class InputError(Exception):
     """Exception raised for input errors.
 
@@ -27,6 +54,283 @@ class InputError(Exception):
         return '%s --> %s'%(self.expression, self.message)
 
     
+class LRUCache(object):
+    """
+    Least-recently-used cache of expensive intermediate products (e.g. reprojection weights).
+
+    Cached values are never pickled, so objects holding a cache can be sent to
+    multiprocessing workers without shipping its content along with them. 
+    Access is serialised with a lock, so that a cache can be shared by threads.
+
+    Parameters
+    ----------
+    maxsize : int
+        Maximum number of entries to keep. If 0 or None, nothing is cached.
+    """
+    def __init__(self, maxsize=4):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+    
+    def __contains__(self, key):
+        return key in self._data
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._data[key]
+            except KeyError:
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        if not self.maxsize:
+            return value
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __getstate__(self):
+        return {'maxsize': self.maxsize}
+
+    def __setstate__(self, state):
+        self.maxsize = state['maxsize']
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+
+class KeplerianMask(object):
+    """
+    Boolean mask of a datacube, stored compactly as a range of channels [lo, hi) for each spatial pixel.
+    Pixels with lo >= hi are fully masked.
+
+    Usually obtained from the velocity and line width maps of a model, see `~discminer.disc2d.Model.make_keplerian_mask`.
+
+    Parameters
+    ----------
+    lo, hi : array_like, shape (ny, nx)
+        First and last (exclusive) unmasked channel of each pixel.
+
+    nchan : int
+        Number of channels of the cube.
+    """
+    def __init__(self, lo, hi, nchan):
+        self.lo = np.asarray(lo, dtype=int)
+        self.hi = np.asarray(hi, dtype=int)
+        self.nchan = nchan
+
+    @classmethod
+    def from_velocities(cls, vlo, vhi, vchannels):
+        """
+        Mask channels whose velocity is outside [vlo, vhi] in each pixel. vchannels can be in increasing or decreasing order.
+        Non-finite velocity bounds mask the pixel.
+        """
+        vchannels = np.asarray(vchannels)
+        nchan = len(vchannels)
+        empty = ~(np.isfinite(vlo) & np.isfinite(vhi))
+        vlo, vhi = np.where(empty, 0, vlo), np.where(empty, 0, vhi)
+        if vchannels[0] <= vchannels[-1]:
+            lo = np.searchsorted(vchannels, vlo, side='left')
+            hi = np.searchsorted(vchannels, vhi, side='right')
+        else:
+            rev = vchannels[::-1]
+            lo = nchan - np.searchsorted(rev, vhi, side='right')
+            hi = nchan - np.searchsorted(rev, vlo, side='left')
+        return cls(np.where(empty, 0, lo), np.where(empty, 0, hi), nchan)
+
+    @property
+    def shape(self):
+        return (self.nchan,) + self.lo.shape
+
+    @property
+    def pixels(self):
+        """2D mask of the pixels with at least one unmasked channel."""
+        return self.hi > self.lo
+
+    @property
+    def nvoxels(self):
+        return int(np.sum(np.clip(self.hi-self.lo, 0, None)))
+
+    @property
+    def cube(self):
+        """Boolean mask with shape (nchan, ny, nx), True for unmasked voxels."""
+        chans = np.arange(self.nchan)[:, None, None]
+        return (chans >= self.lo) & (chans < self.hi)
+
+    def channels(self, i, j):
+        """Slice of unmasked channels of pixel (i, j)."""
+        return slice(self.lo[i,j], max(self.lo[i,j], self.hi[i,j]))
+
+    def pad(self, nchan=1):
+        """Return a new mask with nchan extra channels on each side of the unmasked range of each pixel."""
+        pixels = self.pixels
+        lo = np.where(pixels, np.clip(self.lo-nchan, 0, None), self.lo)
+        hi = np.where(pixels, np.clip(self.hi+nchan, None, self.nchan), self.hi)
+        return KeplerianMask(lo, hi, self.nchan)
+
+    def apply(self, data, fill=np.nan):
+        """Return a copy of data with masked voxels set to fill."""
+        return np.where(self.cube, data, fill)
+
+
+class P2Quantiles(object):
+    """
+    Online quantile estimates with the P-square algorithm (Jain & Chlamtac 1985), for several independent variables at once.
+    Each quantile of each variable is tracked by 5 markers, so memory does not grow with the number of observations.
+    Observations are added in blocks (e.g. the walkers of an MCMC step), with one vectorised marker update per block:
+    marker positions are shifted by the number of observations below each marker, and interior markers are then moved 
+    by up to the integer part of their offset from the desired positions, with the piecewise-parabolic formula. 
+    With one observation per block this is the original algorithm. The first block with 5 or more observations initialises 
+    the markers at its exact quantiles.
+
+    Parameters
+    ----------
+    probs : array_like, shape (nprobs,)
+        Probabilities of the quantiles to estimate, between 0 and 1.
+
+    nvars : int
+        Number of variables, e.g. of model parameters.
+    """
+    def __init__(self, probs, nvars):
+        self.probs = np.atleast_1d(probs).astype(float)
+        self.nvars = nvars
+        self.count = 0
+        p = self.probs[:, None]
+        self._dn = np.hstack([0*p, p/2, p, (1+p)/2, 1+0*p]) #increments of desired marker positions, shape (nprobs, 5)
+        self._nd = np.hstack([1+0*p, 1+2*p, 1+4*p, 3+2*p, 5+0*p]) #desired marker positions
+        self._n = np.tile(np.arange(1.0, 6.0), (len(self.probs), nvars, 1)) #marker positions, shape (nprobs, nvars, 5)
+        self._q = np.zeros((len(self.probs), nvars, 5)) #marker heights
+
+    def update(self, x):
+        """Add a block of observations x, with shape (nvars,) or (nobs, nvars)."""
+        x = np.atleast_2d(np.asarray(x, dtype=float))
+        if not self.count and len(x) >= 5: #markers at the exact quantiles of the first block
+            m = len(x)
+            self._nd = 1 + (m-1)*self._dn
+            self._n = np.broadcast_to(self._nd[:, None, :], self._n.shape).copy()
+            self._q = np.moveaxis(np.quantile(x, self._dn, axis=0), 1, -1) #shape (nprobs, nvars, 5)
+            self.count = m
+            return
+        while self.count < 5 and len(x): #the first 5 observations initialise the markers
+            self._q[..., self.count] = x[0]
+            self.count += 1
+            x = x[1:]
+            if self.count == 5: self._q.sort(axis=-1)
+        if len(x): self._update(x)
+
+    def _update(self, x):
+        m = len(x)
+        self.count += m
+        q, n = self._q, self._n
+        for i in range(1, 4): n[..., i] += np.sum(x[None] < q[:, None, :, i], axis=1) #observations below each interior marker
+        n[..., 4] += m
+        np.minimum(q[..., 0], x.min(axis=0), out=q[..., 0])
+        np.maximum(q[..., 4], x.max(axis=0), out=q[..., 4])
+        self._nd += m*self._dn
+        nd = self._nd[:, None, :]
+        for i in range(1, 4): #adjust interior markers
+            d = nd[..., i] - n[..., i]
+            move = ((d >= 1) & (n[..., i+1]-n[..., i] > 1)) | ((d <= -1) & (n[..., i-1]-n[..., i] < -1))
+            if not move.any(): continue
+            s = np.clip(np.trunc(d), n[..., i-1]-n[..., i]+1, n[..., i+1]-n[..., i]-1) #stay between neighbouring markers
+            qi, qm, qp = q[..., i], q[..., i-1], q[..., i+1]
+            ni, nm, np_ = n[..., i], n[..., i-1], n[..., i+1]
+            parab = qi + s/(np_-nm) * ((ni-nm+s)*(qp-qi)/(np_-ni) + (np_-ni-s)*(qi-qm)/(ni-nm))
+            qj, nj = np.where(s > 0, qp, qm), np.where(s > 0, np_, nm)
+            linear = qi + s*(qj-qi)/(nj-ni)
+            new = np.where((qm < parab) & (parab < qp), parab, linear)
+            q[..., i] = np.where(move, new, qi)
+            n[..., i] += np.where(move, s, 0)
+
+    @property
+    def estimate(self):
+        """Current quantile estimates, shape (nprobs, nvars). Exact for fewer than 5 observations, NaN if there are none."""
+        if self.count >= 5: return self._q[..., 2].copy()
+        if not self.count: return np.full((len(self.probs), self.nvars), np.nan)
+        return np.percentile(self._q[0, :, :self.count], 100*self.probs, axis=-1)
+
+
+class OnlineSummary(object):
+    """
+    Running summary of MCMC chains, updated with the walker positions of each step without storing the chains:
+    median and +- errors of each parameter (P-square estimates of the percentiles 50 -+ width/2), and fraction of steps in which each walker moved.
+
+    Parameters
+    ----------
+    nwalkers, nparams : int
+        Number of walkers and parameters.
+
+    width : float
+        Percentage of samples enclosed by the errors. Defaults to 68.2 (1 sigma).
+    """
+    def __init__(self, nwalkers, nparams, width=68.2):
+        p = width/200.
+        self.quantiles = P2Quantiles([0.5-p, 0.5, 0.5+p], nparams)
+        self.nsteps = 0
+        self._moved = np.zeros(nwalkers)
+        self._last = None
+
+    def update(self, coords, quantiles=True):
+        """
+        Add a step of the chains, coords with shape (nwalkers, nparams). The quantiles are updated once with the whole step, see `P2Quantiles`.
+        If quantiles is False, the step only counts towards the acceptance fractions (e.g. during burn-in).
+        """
+        coords = np.asarray(coords)
+        if self._last is not None:
+            self._moved += np.any(coords != self._last, axis=-1)
+            self.nsteps += 1
+        self._last = coords.copy()
+        if quantiles: self.quantiles.update(coords)
+
+    def reset_quantiles(self, samples=None):
+        """Restart the quantile estimates, e.g. when the statistics window changes, from samples with shape (nsamples, nparams) if given."""
+        self.quantiles = P2Quantiles(self.quantiles.probs, self.quantiles.nvars)
+        if samples is not None: self.quantiles.update(samples)
+
+    @property
+    def median(self):
+        return self.quantiles.estimate[1]
+
+    @property
+    def errneg(self):
+        q = self.quantiles.estimate
+        return q[1] - q[0]
+
+    @property
+    def errpos(self):
+        q = self.quantiles.estimate
+        return q[2] - q[1]
+
+    @property
+    def acceptance_fraction(self):
+        """Fraction of steps in which each walker moved. Equal to the acceptance fraction if every step is stored."""
+        return self._moved / max(1, self.nsteps)
+
+
+def _freeze(obj):
+    """Turn (nested) parameter containers into a hashable key for `LRUCache`."""
+    if isinstance(obj, dict):
+        return tuple(sorted((key, _freeze(val)) for key, val in obj.items()))
+    if isinstance(obj, (list, tuple)):
+        return tuple(_freeze(val) for val in obj)
+    if isinstance(obj, np.ndarray):
+        return (obj.shape, obj.dtype.str, obj.tobytes())
+    if isinstance(obj, np.generic):
+        return obj.item()
+    return obj
+
+    
 class FrontendUtils(object):
     """
     Make outputs prettier
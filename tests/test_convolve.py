@@ -0,0 +1,30 @@
+import numpy as np
+import pytest
+from astropy.convolution import Gaussian2DKernel, convolve
+
+from discminer.disc2d import Intensity
+
+
+@pytest.fixture
+def model():
+    model = Intensity()
+    model.beam_kernel = Gaussian2DKernel(x_stddev=2.5, y_stddev=1.5, theta=0.5)
+    model.fft_workers = 1
+    return model
+
+
+@pytest.mark.parametrize('shape', [(4, 48, 48), (3, 33, 47)])
+def test_fft_matches_astropy(model, shape):
+    chans = np.random.default_rng(0).normal(size=shape)
+    ref = np.array([convolve(chan, model.beam_kernel, preserve_nan=False) for chan in chans])
+    conv = model._convolve_fft(chans)
+    assert conv.shape == chans.shape
+    np.testing.assert_allclose(conv, ref, rtol=1e-10, atol=1e-12)
+
+
+def test_fft_kernel_cache_reset(model):
+    chans = np.random.default_rng(1).normal(size=(2, 40, 40))
+    model._convolve_fft(chans) #caches the padded kernel FFT
+    model.beam_kernel = Gaussian2DKernel(x_stddev=1.0)
+    ref = np.array([convolve(chan, model.beam_kernel, preserve_nan=False) for chan in chans])
+    np.testing.assert_allclose(model._convolve_fft(chans), ref, rtol=1e-10, atol=1e-12)
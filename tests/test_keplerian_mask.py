@@ -0,0 +1,18 @@
+import numpy as np
+
+from discminer.disc2d import Model
+from discminer.tools.utils import KeplerianMask
+
+
+def test_infinite_halfwidth_unmasks_all_channels():
+    vchannels = np.linspace(-3, 3, 31)
+    vel = np.array([[0.0, 1.0], [np.nan, 2.5]])
+    half = np.array([[np.inf, 0.25], [np.inf, 1e300]])
+    lo, hi = Model._get_velocity_bounds(vel, half, vchannels)
+    mask = KeplerianMask.from_velocities(lo, hi, vchannels)
+    np.testing.assert_array_equal(mask.lo, [[0, 19], [0, 0]])
+    np.testing.assert_array_equal(mask.hi, [[31, 22], [0, 31]])
+    assert not mask.pixels[1, 0] #outside the disc
+
+    mask_rev = KeplerianMask.from_velocities(lo, hi, vchannels[::-1])
+    np.testing.assert_array_equal(mask_rev.hi - mask_rev.lo, mask.hi - mask.lo)
@@ -0,0 +1,43 @@
+import numpy as np
+import pytest
+
+from discminer.disc2d import Intensity
+
+
+def _dense_channel_average(profile, dv, v_sigma, b_slope, channel_width, nsub=20001):
+    #Midpoint-rule average of the profile over each channel, sampling it every channel_width/nsub
+    u = (np.arange(nsub) + 0.5)/nsub - 0.5
+    vchan = dv[:, None] + channel_width*u
+    return np.mean(profile(vchan, 0.0, v_sigma, b_slope), axis=-1)
+
+
+@pytest.mark.parametrize('b_slope', [0.005, 0.1, 0.5, 1.0, 2.0, 5.0, 10.0, 20.0])
+@pytest.mark.parametrize('linewidth', [0.1, 0.5, 1.0, 4.0]) #in channel widths
+def test_bell_full_matches_dense_sampling(b_slope, linewidth):
+    channel_width = 0.2
+    v_sigma = linewidth*channel_width
+    dv = np.linspace(-3*v_sigma-channel_width, 3*v_sigma+channel_width, 81)
+    ref = _dense_channel_average(Intensity.line_profile_bell, dv, v_sigma, b_slope, channel_width)
+    prof = Intensity.line_profile_bell_full(dv, 0.0, v_sigma, b_slope, channel_width=channel_width)
+    assert np.max(np.abs(prof-ref)) < 1e-4*np.max(ref)
+
+
+def test_bell_full_keeps_dtype():
+    dv = np.linspace(-1, 1, 11, dtype=np.float32)
+    prof = Intensity.line_profile_bell_full(dv, np.float32(0.1), np.float32(0.3), 2.0, channel_width=0.2)
+    assert prof.dtype == np.float32
+
+
+@pytest.mark.parametrize('b_slope', [0.5, 1.0, 2.0, 5.0])
+@pytest.mark.parametrize('cutoff', [3.0, 5.0])
+def test_bell_halfwidth_matches_gaussian_tolerance(b_slope, cutoff):
+    model = Intensity()
+    model._use_temperature = model._use_full_channel = False
+    model._line_profile_cutoff = cutoff
+    model.line_profile = Intensity.line_profile_bell
+    v_sigma = 0.3
+    half = model._get_profile_halfwidth(v_sigma, b_slope=b_slope)
+    tol = Intensity.line_profile_v_sigma(cutoff*v_sigma, 0.0, v_sigma, None)
+    np.testing.assert_allclose(Intensity.line_profile_bell(half, 0.0, v_sigma, b_slope), tol, rtol=1e-8)
+    model.line_profile = Intensity.line_profile_v_sigma #Gaussian kernel, cutoff linewidths
+    np.testing.assert_allclose(model._get_profile_halfwidth(v_sigma, b_slope=b_slope), cutoff*v_sigma)
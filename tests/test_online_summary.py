@@ -0,0 +1,22 @@
+import numpy as np
+
+from discminer.tools.utils import OnlineSummary, P2Quantiles
+
+
+def test_p2_blocks_match_exact_quantiles():
+    rng = np.random.default_rng(0)
+    chain = np.concatenate([rng.normal(size=(500, 32, 2)), rng.standard_exponential(size=(500, 32, 1))], axis=-1) #(nsteps, nwalkers, nparams)
+    summary = OnlineSummary(32, 3)
+    for coords in chain: summary.update(coords)
+    samples = chain.reshape(-1, 3)
+    lo, med, hi = np.quantile(samples, [0.5-0.341, 0.5, 0.5+0.341], axis=0)
+    for est, ref in [(summary.median, med), (summary.errneg, med-lo), (summary.errpos, hi-med)]:
+        assert np.all(np.abs(est-ref) < 0.01*(hi-lo))
+
+
+def test_p2_first_block_is_exact():
+    x = np.random.default_rng(1).normal(size=(1000, 2))
+    quantiles = P2Quantiles([0.25, 0.5, 0.75], 2)
+    quantiles.update(x)
+    np.testing.assert_allclose(quantiles.estimate, np.quantile(x, [0.25, 0.5, 0.75], axis=0))
+    assert quantiles.count == 1000